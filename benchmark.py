@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import io
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+from endotool import fixtures, font, scripts, images, jis208
+
+parser = argparse.ArgumentParser(
+    description = 'Times font, script and image extraction and rebuilding on synthetic game files.',
+    formatter_class = argparse.ArgumentDefaultsHelpFormatter
+    )
+
+parser.add_argument(
+    '-d',
+    # '--work-dir',
+    required = False,
+    action = 'store',
+    metavar = '[folder]',
+    help = 'Folder for the synthetic game files and outputs. Kept after the run. Defaults to a temporary folder.'
+    )
+
+parser.add_argument(
+    '-t',
+    # '--texture-size',
+    required = False,
+    type = int,
+    default = 4,
+    action = 'store',
+    metavar = '[MB]',
+    help = 'Size of the texture section of the synthetic EXO.BIN.'
+    )
+
+parser.add_argument(
+    '-b',
+    # '--blocks',
+    required = False,
+    type = int,
+    default = 1000,
+    action = 'store',
+    metavar = '[count]',
+    help = 'Number of EXO script blocks.'
+    )
+
+parser.add_argument(
+    '-e',
+    # '--elf-texts',
+    required = False,
+    type = int,
+    default = 2000,
+    action = 'store',
+    metavar = '[count]',
+    help = 'Number of ELF texts.'
+    )
+
+parser.add_argument(
+    '-n',
+    # '--repeat',
+    required = False,
+    type = int,
+    default = 3,
+    action = 'store',
+    metavar = '[count]',
+    help = 'Number of times to run each benchmark. The fastest run is reported.'
+    )
+
+parser.add_argument(
+    '-j',
+    # '--jobs',
+    required = False,
+    type = int,
+    default = 1,
+    action = 'store',
+    metavar = '[workers]',
+    help = 'Number of worker processes passed to the commands that support it.'
+    )
+
+parser.add_argument(
+    '-o',
+    # '--output',
+    required = False,
+    action = 'store',
+    metavar = '[output JSON]',
+    help = 'Save the results to this file.'
+    )
+
+parser.add_argument(
+    '-c',
+    # '--compare',
+    required = False,
+    action = 'store',
+    metavar = '[input JSON]',
+    help = 'Results of a previous run to compare against. Exits with an error if any benchmark got slower than allowed by -m.'
+    )
+
+parser.add_argument(
+    '-m',
+    # '--max-slowdown',
+    required = False,
+    type = float,
+    default = 1.25,
+    action = 'store',
+    metavar = '[ratio]',
+    help = 'Largest allowed ratio between the new and previous time of a benchmark.'
+    )
+
+
+def run(name, func, items, size, repeat, setup = None):
+    """
+    Time func, keeping the fastest of several runs. Output from the commands is hidden.
+    """
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            rv = func()
+            seconds = time.perf_counter() - start
+        ## The commands return an exit code when they fail
+        if isinstance(rv, int) and rv:
+            raise Exception(f'{name} failed with exit code {rv}')
+        if best is None or seconds < best:
+            best = seconds
+
+    result = {
+        'seconds': round(best, 4),
+        'items': items,
+        'bytes': size,
+        'items_per_sec': round(items / best, 1),
+        'mb_per_sec': round(size / best / 1024 / 1024, 2),
+    }
+    print(f"{name:<16} {best:>8.3f}s {result['items_per_sec']:>12.1f} items/s {result['mb_per_sec']:>9.2f} MB/s")
+    return result
+
+
+def benchmark(dir_work, texture_end, num_blocks, num_elf_texts, repeat = 3, jobs = 1):
+    print("Generating game files")
+    fx = fixtures.generate(dir_work, texture_end = texture_end, num_blocks = num_blocks, num_elf_texts = num_elf_texts)
+    print(f"{fx.num_textures} textures, {fx.num_blocks} script blocks, {fx.num_elf_texts} ELF texts")
+    print()
+
+    ## The synthetic textures end earlier than the real ones
+    images.TEXTURE_END = texture_end
+
+    def path(name):
+        return os.path.join(dir_work, name)
+
+    def remove(name):
+        if os.path.isdir(path(name)):
+            shutil.rmtree(path(name))
+        elif os.path.exists(path(name)):
+            os.remove(path(name))
+
+    font_size = font.PALETTE_SIZE + font.WIDTH * font.HEIGHT * font.BITDEPTH // 8
+    script_items = fx.num_blocks + fx.num_elf_texts
+
+    results = {}
+    results['font-extract'] = run('font-extract',
+        lambda: font.extract(fx.fname_elf, path('font.png')),
+        font.NUM_GLYPHS, font_size, repeat)
+    results['font-rebuild'] = run('font-rebuild',
+        lambda: font.rebuild(path('font.png'), fx.fname_elf, path('ELF_font')),
+        font.NUM_GLYPHS, font_size, repeat)
+    results['script-extract'] = run('script-extract',
+        lambda: scripts.extract(fx.fname_elf, fx.fname_exo, path('script.csv'), overwrite = True, jobs = jobs),
+        script_items, fx.block_bytes, repeat)
+    results['script-rebuild'] = run('script-rebuild',
+        lambda: scripts.rebuild(path('script.csv'), fx.fname_elf, path('ELF_script'), fx.fname_exo, path('EXO_script'), jobs = jobs),
+        script_items, fx.block_bytes, repeat)
+    ## Without the saved texture list, so the scan is included
+    results['image-extract'] = run('image-extract',
+        lambda: images.unpack(fx.fname_exo, path('images'), jobs = jobs),
+        fx.num_textures, fx.texture_bytes, repeat,
+        setup = lambda: remove(os.path.basename(fx.fname_exo) + images.TOC_SUFFIX))
+    results['image-rebuild'] = run('image-rebuild',
+        lambda: images.rebuild(path('images'), fx.fname_exo, path('EXO_images'), jobs = jobs),
+        fx.num_textures, fx.texture_bytes, repeat)
+
+    ## Every text in the script, decoded and encoded again
+    rows = scripts.readCsvRows(path('script.csv'))
+    next(rows)
+    texts = [row[5] for row in rows if len(row) > 5]
+    ## Texts are null terminated in the game files
+    encoded = [jis208.stringToHex(text) + b'\0' for text in texts]
+    text_bytes = sum(len(data) for data in encoded)
+
+    results['jis208-encode'] = run('jis208-encode',
+        lambda: [jis208.stringToHex(text) for text in texts],
+        len(texts), text_bytes, repeat)
+    results['jis208-decode'] = run('jis208-decode',
+        lambda: [jis208.decodeBuffer(data) for data in encoded],
+        len(texts), text_bytes, repeat)
+
+    return results
+
+
+def compare(results, previous, max_slowdown):
+    """
+    Print the benchmarks that got slower. Returns True if none went over max_slowdown.
+    """
+    ok = True
+    print()
+    for name, result in results.items():
+        if name not in previous:
+            continue
+        ratio = result['seconds'] / max(previous[name]['seconds'], 1e-9)
+        status = 'ok'
+        if ratio > max_slowdown:
+            status = 'SLOWER'
+            ok = False
+        print(f"{name:<16} {previous[name]['seconds']:>8.3f}s -> {result['seconds']:>8.3f}s  x{ratio:.2f} {status}")
+    return ok
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    dir_work = args.d or tempfile.mkdtemp(prefix='endotool-bench-')
+    try:
+        results = benchmark(
+            dir_work,
+            texture_end = args.t * 1024 * 1024,
+            num_blocks = args.b,
+            num_elf_texts = args.e,
+            repeat = args.n,
+            jobs = args.j,
+        )
+    finally:
+        if not args.d:
+            shutil.rmtree(dir_work, ignore_errors=True)
+
+    if args.o:
+        with open(args.o, 'w') as f:
+            f.write(json.dumps(results, indent=4))
+
+    if args.c:
+        with open(args.c, 'r') as f:
+            previous = json.loads(f.read())
+        if not compare(results, previous, args.m):
+            sys.exit(1)
@@ -4,8 +4,10 @@ import sys
 import argparse
 import os
 import inspect
+import cProfile
 
-from endotool import utils, font, scripts, images
+from endotool import utils, font, scripts, images, build, profiler
+from endotool.progress import ProgressBar
 
 filename = inspect.getframeinfo(inspect.currentframe()).filename
 basedir = os.path.dirname(os.path.abspath(filename))
@@ -23,6 +25,45 @@ parser = EndonesiaParser(
     formatter_class = argparse.ArgumentDefaultsHelpFormatter
     )
 
+#########
+## Global options. These go before the command. The profiling options only
+## have long names, since -p is taken by the rebuild commands.
+#########
+parser.add_argument(
+    '-q',
+    # '--quiet',
+    action = 'store_true',
+    help = 'Don\'t show progress bars.'
+    )
+
+parser.add_argument(
+    '--profile',
+    action = 'store_true',
+    help = 'When the command finishes, print how long each stage took along with item and byte counts.'
+    )
+
+parser.add_argument(
+    '--profile-output',
+    required = False,
+    action = 'store',
+    metavar = '[output file]',
+    help = 'Save the profiling report to this file. Saved as JSON if the name ends in .json, otherwise as text. Implies --profile.'
+    )
+
+parser.add_argument(
+    '--profile-memory',
+    action = 'store_true',
+    help = 'Also record the peak memory of each stage with tracemalloc. This makes the command slower. Implies --profile.'
+    )
+
+parser.add_argument(
+    '--cprofile',
+    required = False,
+    action = 'store',
+    metavar = '[output file]',
+    help = 'Run the command under cProfile and save the statistics to this file. Only covers the main process.'
+    )
+
 subparser = parser.add_subparsers(
     dest = 'cmd',
     help = 'Available commands'
@@ -50,7 +91,7 @@ font_extract_parser.add_argument(
     required = True,
     action = 'store',
     metavar = '[output IMAGE]',
-    help = 'Output image in BMP format.'
+    help = 'Output image. Saved as PNG if the name ends in .png, otherwise as BMP.'
     )
 
 #########
@@ -96,6 +137,13 @@ font_rebuild_parser.add_argument(
     help = 'Output ELF file'
     )
 
+font_rebuild_parser.add_argument(
+    '-p',
+    # '--in-place',
+    action = 'store_true',
+    help = 'Patch the output file directly if it was previously rebuilt from the same, unchanged, input file. Default behavior is to start from a fresh copy of the input.'
+    )
+
 #########
 ## Script extract
 #########
@@ -137,6 +185,17 @@ script_extract_parser.add_argument(
     help = 'If this flag is enabled and the CSV output file already exists, the CSV file will be overwritten. Default behavior is to only add new entries and leave the existing ones alone.'
     )
 
+script_extract_parser.add_argument(
+    '-j',
+    # '--jobs',
+    required = False,
+    type = int,
+    default = os.cpu_count() or 1,
+    action = 'store',
+    metavar = '[workers]',
+    help = 'Number of worker processes used to decode script blocks.'
+    )
+
 #########
 ## Script rebuild
 #########
@@ -189,6 +248,24 @@ script_rebuild_parser.add_argument(
     help = 'Output EXO.BIN assets file to rebuild scripts into.'
     )
 
+script_rebuild_parser.add_argument(
+    '-p',
+    # '--in-place',
+    action = 'store_true',
+    help = 'Patch the output file directly if it was previously rebuilt from the same, unchanged, input file. Default behavior is to start from a fresh copy of the input.'
+    )
+
+script_rebuild_parser.add_argument(
+    '-j',
+    # '--jobs',
+    required = False,
+    type = int,
+    default = os.cpu_count() or 1,
+    action = 'store',
+    metavar = '[workers]',
+    help = 'Number of worker processes used to decode and encode script blocks.'
+    )
+
 #########
 ## Font extract
 #########
@@ -214,6 +291,91 @@ image_extract_parser.add_argument(
     help = 'directory to dump images into.'
     )
 
+image_extract_parser.add_argument(
+    '-j',
+    # '--jobs',
+    required = False,
+    type = int,
+    default = os.cpu_count() or 1,
+    action = 'store',
+    metavar = '[workers]',
+    help = 'Number of worker processes used to convert images.'
+    )
+
+image_extract_parser.add_argument(
+    '-t',
+    # '--only',
+    required = False,
+    action = 'store',
+    metavar = '[textures]',
+    help = 'Comma-separated list of textures to extract, either by name (00001-00000880-08) or by sector number (1).'
+    )
+
+image_extract_parser.add_argument(
+    '-s',
+    # '--range',
+    required = False,
+    action = 'store',
+    metavar = '[first-last]',
+    help = 'Only extract textures that start between these sectors. Either end can be left out, e.g. 100- or -200.'
+    )
+
+image_extract_parser.add_argument(
+    '-b',
+    # '--bitdepth',
+    required = False,
+    type = int,
+    choices = [8, 24],
+    action = 'store',
+    metavar = '[bitdepth]',
+    help = 'Only extract textures with this bitdepth (8 or 24).'
+    )
+
+#########
+## Image list
+#########
+image_list_parser = subparser.add_parser('image-list',
+    help = 'List the textures in EXO.BIN.'
+    )
+
+image_list_parser.add_argument(
+    '-x',
+    # '--exofin',
+    required = True,
+    action = 'store',
+    metavar = '[input EXO.BIN]',
+    help = 'EXO.BIN assets file to list textures from.'
+    )
+
+image_list_parser.add_argument(
+    '-t',
+    # '--only',
+    required = False,
+    action = 'store',
+    metavar = '[textures]',
+    help = 'Comma-separated list of textures to list, either by name (00001-00000880-08) or by sector number (1).'
+    )
+
+image_list_parser.add_argument(
+    '-s',
+    # '--range',
+    required = False,
+    action = 'store',
+    metavar = '[first-last]',
+    help = 'Only list textures that start between these sectors. Either end can be left out, e.g. 100- or -200.'
+    )
+
+image_list_parser.add_argument(
+    '-b',
+    # '--bitdepth',
+    required = False,
+    type = int,
+    choices = [8, 24],
+    action = 'store',
+    metavar = '[bitdepth]',
+    help = 'Only list textures with this bitdepth (8 or 24).'
+    )
+
 #########
 ## Font extract
 #########
@@ -248,54 +410,152 @@ image_rebuild_parser.add_argument(
     help = 'Output EXO.BIN assets file to rebuild images into.'
     )
 
+image_rebuild_parser.add_argument(
+    '-j',
+    # '--jobs',
+    required = False,
+    type = int,
+    default = os.cpu_count() or 1,
+    action = 'store',
+    metavar = '[workers]',
+    help = 'Number of worker processes used to convert images.'
+    )
+
+image_rebuild_parser.add_argument(
+    '-p',
+    # '--in-place',
+    action = 'store_true',
+    help = 'Only rebuild the images and JSON files that changed since the last rebuild into the same output file. Default behavior is to rebuild every image from a fresh copy of the input.'
+    )
 
-# try:
-args = parser.parse_args()
 
-if args.cmd == 'font-extract':
-    font.extract(
-        fname_elf = args.e,
-        fname_font = args.f
+#########
+## Build
+#########
+build_parser = subparser.add_parser('build',
+    help = 'Rebuild the font, scripts and images into the game files in one pass.'
+    )
+
+build_parser.add_argument(
+    '-i',
+    # '--project',
+    required = True,
+    action = 'store',
+    metavar = '[input JSON]',
+    help = 'Project file listing the game files and the font, CSV and image folder to rebuild from.'
+    )
+
+build_parser.add_argument(
+    '-j',
+    # '--jobs',
+    required = False,
+    type = int,
+    default = os.cpu_count() or 1,
+    action = 'store',
+    metavar = '[workers]',
+    help = 'Number of worker processes used to convert images and script blocks.'
+    )
+
+
+def run_command(args):
+    ## Progress goes to stderr, so it stays out of redirected output
+    progress = None if args.q else ProgressBar()
+
+    if args.cmd == 'font-extract':
+        return font.extract(
+            fname_elf = args.e,
+            fname_font = args.f
+            )
+    elif args.cmd == 'font-rebuild':
+        return font.rebuild(
+            fname_font = args.f,
+            variable_width = args.v,
+            fname_elf_in = args.ei,
+            fname_elf_out = args.eo,
+            in_place = args.p,
+            progress = progress,
+        )
+    elif args.cmd == 'script-extract':
+        return scripts.extract(
+            fname_elf = args.e,
+            fname_exo = args.x,
+            fname_csv = args.c,
+            overwrite = args.r,
+            jobs = args.j,
+            progress = progress,
+            )
+    elif args.cmd == 'script-rebuild':
+        return scripts.rebuild(
+            fname_csv = args.c,
+            fname_elf_in = args.ei,
+            fname_elf_out = args.eo,
+            fname_exo_in = args.xi,
+            fname_exo_out = args.xo,
+            in_place = args.p,
+            jobs = args.j,
+            progress = progress,
+        )
+    elif args.cmd == 'image-extract':
+        return images.unpack(
+            fname_exo = args.x,
+            dir_output = args.o,
+            jobs = args.j,
+            only = args.t,
+            sector_range = args.s,
+            bitdepth = args.b,
+            progress = progress,
+        )
+    elif args.cmd == 'image-list':
+        return images.list_textures(
+            fname_exo = args.x,
+            only = args.t,
+            sector_range = args.s,
+            bitdepth = args.b,
+        )
+    elif args.cmd == 'image-rebuild':
+        return images.rebuild(
+            dir_input = args.i,
+            fname_exo_in = args.xi,
+            fname_exo_out = args.xo,
+            jobs = args.j,
+            in_place = args.p,
+            progress = progress,
         )
-elif args.cmd == 'font-rebuild':
-    font.rebuild(
-        fname_font = args.f,
-        variable_width = args.v,
-        fname_elf_in = args.ei,
-        fname_elf_out = args.eo,
-    )
-elif args.cmd == 'script-extract':
-    scripts.extract(
-        fname_elf = args.e,
-        fname_exo = args.x,
-        fname_csv = args.c,
-        overwrite = args.r
+    elif args.cmd == 'build':
+        return build.build(
+            fname_project = args.i,
+            jobs = args.j,
+            progress = progress,
         )
-elif args.cmd == 'script-rebuild':
-    scripts.rebuild(
-        fname_csv = args.c,
-        fname_elf_in = args.ei,
-        fname_elf_out = args.eo,
-        fname_exo_in = args.xi,
-        fname_exo_out = args.xo,
-    )
-elif args.cmd == 'image-extract':
-    images.unpack(
-        fname_exo = args.x,
-        dir_output = args.o,
-    )
-elif args.cmd == 'image-rebuild':
-    images.rebuild(
-        dir_input = args.i,
-        fname_exo_in = args.xi,
-        fname_exo_out = args.xo,
-    )
-#     scripts.calculateFreeSpace(args.elf_file, args.exo_bin)
-
-if len(sys.argv)==1:
-    parser.print_help(sys.stderr)
-    sys.exit(1)
-
-# except IOError as e:
-    # print(e, file = sys.stderr)
-    # sys.exit(2)
\ No newline at end of file
+    #     scripts.calculateFreeSpace(args.elf_file, args.exo_bin)
+
+
+## Worker processes re-import this file on some platforms, so only run the
+## command from the main process
+if __name__ == '__main__':
+    # try:
+    args = parser.parse_args()
+
+    if args.profile or args.profile_output or args.profile_memory:
+        profiler.enable(memory = args.profile_memory)
+
+    if args.cprofile:
+        profile = cProfile.Profile()
+        profile.runcall(run_command, args)
+        profile.dump_stats(args.cprofile)
+    else:
+        run_command(args)
+
+    if profiler.enabled:
+        report = profiler.report()
+        print(profiler.format_report(report), file = sys.stderr)
+        if args.profile_output:
+            profiler.save_report(report, args.profile_output)
+
+    if len(sys.argv)==1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    # except IOError as e:
+        # print(e, file = sys.stderr)
+        # sys.exit(2)
\ No newline at end of file
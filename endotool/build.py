@@ -0,0 +1,74 @@
+import os
+import sys
+import io
+import json
+
+from endotool import font, scripts, images
+from endotool.exo import ExoArchive
+
+REQUIRED_KEYS = ['elf_in', 'elf_out', 'exo_in', 'exo_out']
+
+
+def load_project(fname_project):
+    """
+    Read a project JSON file. Paths are relative to the project file.
+    """
+    with open(fname_project, 'r', encoding='utf-8') as f:
+        project = json.loads(f.read())
+
+    basedir = os.path.dirname(os.path.abspath(fname_project))
+    for key, value in project.items():
+        if isinstance(value, str):
+            project[key] = os.path.join(basedir, value)
+
+    return project
+
+
+def build(fname_project, jobs = 1, progress = None):
+    try:
+        project = load_project(fname_project)
+    except (IOError, ValueError) as e:
+        print(e, file = sys.stderr)
+        return 2
+
+    for key in REQUIRED_KEYS:
+        if key not in project:
+            print(f'Project file is missing "{key}".', file = sys.stderr)
+            return 2
+
+    ## Every stage works on these buffers. Nothing is written until the end.
+    print("Loading game files")
+    with open(project['elf_in'], 'rb') as f:
+        elf = io.BytesIO(f.read())
+    exo_in = ExoArchive(project['exo_in'])
+    exo = io.BytesIO(exo_in.view)
+
+    if 'font' in project:
+        print("== FONT ==")
+        rv = font.pack_font(project['font'], elf, project.get('font_widths'), progress = progress)
+        if rv:
+            exo_in.close()
+            return rv
+
+    if 'csv' in project:
+        print("== SCRIPT ==")
+        scripts.pack_scripts(project['csv'], elf, exo_in, elf, exo, jobs, progress = progress)
+
+    exo_in.close()
+
+    if 'images' in project:
+        print("== IMAGES ==")
+        images.pack_images(project['images'], exo, jobs = jobs, progress = progress)
+
+    print("Writing game files")
+    with open(project['elf_out'], 'wb') as f:
+        f.write(elf.getbuffer())
+    with open(project['exo_out'], 'wb') as f:
+        f.write(exo.getbuffer())
+
+    if 'font' in project and project.get('font_widths'):
+        rv = font.apply_variable_width_code(project['elf_out'])
+        if rv:
+            return rv
+
+    print("Build complete")
@@ -0,0 +1,64 @@
+import mmap
+import struct
+
+SECTOR_SIZE = 2048
+
+
+class ExoArchive:
+    """
+    Read-only, memory-mapped view of an EXO.BIN file.
+
+    Sectors and blocks are returned as memoryview slices of the mapping, so
+    nothing is copied until the caller converts them to bytes.
+    """
+
+    def __init__(self, fname : str) -> None:
+        self.fname = fname
+        self.file = open(fname, 'rb')
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            ## Empty files can't be mapped
+            self.file.close()
+            raise
+        self.view = memoryview(self.mm)
+
+    def __len__(self) -> int:
+        return len(self.mm)
+
+    def __enter__(self) -> 'ExoArchive':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.view.release()
+        try:
+            self.mm.close()
+        except BufferError:
+            ## Slices handed out earlier are still alive. The mapping is
+            ## released once they are garbage collected.
+            pass
+        self.file.close()
+
+    def sector(self, index : int, count : int = 1) -> memoryview:
+        return self.view[index*SECTOR_SIZE : (index+count)*SECTOR_SIZE]
+
+    def block(self, offset : int, size : int) -> memoryview:
+        return self.view[offset : offset+size]
+
+    def find(self, sub : bytes, start : int = 0, end : int = None) -> int:
+        return self.mm.find(sub, start, len(self.mm) if end is None else end)
+
+    def rfind(self, sub : bytes, start : int = 0, end : int = None) -> int:
+        return self.mm.rfind(sub, start, len(self.mm) if end is None else end)
+
+    def u8(self, offset : int) -> int:
+        return self.mm[offset]
+
+    def u16(self, offset : int) -> int:
+        return struct.unpack_from('<H', self.mm, offset)[0]
+
+    def u32(self, offset : int) -> int:
+        return struct.unpack_from('<I', self.mm, offset)[0]
@@ -1,45 +1,22 @@
 import struct
 from typing import List
 from PIL import Image
-from io import BufferedReader
 
-from endotool.utils import pad_to_nearest
-
-def readUInt8(data, offset):
-    return struct.unpack('<B', data[offset:offset+1])[0]
-
-def readUInt16(data, offset):
-    return struct.unpack('<H', data[offset:offset+2])[0]
-
-def readUInt32(data, offset):
-    return struct.unpack('<I', data[offset:offset+4])[0]
-
-def readInt8(data, offset):
-    return struct.unpack('<b', data[offset:offset+1])[0]
-
-def readInt16(data, offset):
-    return struct.unpack('<h', data[offset:offset+2])[0]
-
-def readInt32(data, offset):
-    return struct.unpack('<i', data[offset:offset+4])[0]
-
-def createUInt8(value):
-    return struct.pack('<B', value)
-
-def createUInt16(value):
-    return struct.pack('<H', value)
-
-def createUInt32(value):
-    return struct.pack('<I', value)
-
-def createInt8(value):
-    return struct.pack('<b', value)
-
-def createInt16(value):
-    return struct.pack('<h', value)
-
-def createInt32(value):
-    return struct.pack('<i', value)
+from endotool.utils import pad_to_nearest, padded_size
+
+## Record layouts of the packed image header
+HEADER_START = struct.Struct('<II') # header_size, img_data_offset_qqq
+HEADER_COUNTS = struct.Struct('<HH') # num_frames, num_animations (0 for 32 bit headers)
+HEADER_16 = struct.Struct('<HHIIIIII') # num_frames, num_animations, frames header, animations header, image, width, height, bitdepth
+HEADER_32 = struct.Struct('<HHIIIIIII') # num_frames, 0, num_animations, frames header, animations header, image, width, height, bitdepth
+FRAME_HEADER = struct.Struct('<II') # count, offset to image specifications
+IMAGE_SPECIFICATIONS = struct.Struct('<hhhHHHHhhhHHhhhHH') # read with the crop rect and scales unsigned
+IMAGE_SPECIFICATIONS_PACK = struct.Struct('<17h') # but packed signed, so negative values round-trip
+ANIMATION = struct.Struct('<HHIII') # num_aniframes, duration, frame timing data, num_unknown_transforms, unknown transforms
+FRAME_TIMING_16 = struct.Struct('<hH') # frame_num, frame_duration
+FRAME_TIMING_32 = struct.Struct('<iI')
+UNKNOWN_TRANSFORM = struct.Struct('<hhhh')
+UINT32 = struct.Struct('<I')
 
 class PackedImageInfo:
     def __init__(self) -> None:
@@ -60,105 +37,96 @@ class PackedImageInfo:
         self.offset_to_frame_data: int = 0
         self.bits: int = 16
 
-    def from_buffer(self, buffer: BufferedReader) -> None:
-        self.offset_start = buffer.tell()
-        self.header_size = struct.unpack('<I', buffer.read(4))[0]
-        buffer.seek(-4, 1)
-        data = buffer.read(self.header_size + 0x30)
-        self.raw_data = data
+    def from_buffer(self, buffer: memoryview, offset: int = 0) -> None:
+        self.offset_start = offset
+        self.header_size = UINT32.unpack_from(buffer, offset)[0]
+        data = buffer[offset : offset + self.header_size + 0x30]
+        self.raw_data = bytes(data)
 
-        self.header_size = readUInt32(data, 0)
-        self.img_data_offset_qqq = readUInt32(data, 4)
+        self.header_size, self.img_data_offset_qqq = HEADER_START.unpack_from(data, 0)
 
-        num_frames = readUInt16(data, self.header_size + 0x00)
-        num_animations = readUInt16(data, self.header_size + 0x02)
+        num_frames, num_animations = HEADER_COUNTS.unpack_from(data, self.header_size)
         if num_animations > 0:
             self.bits = 16
-            self.offset_to_frames_header = readUInt32(data, self.header_size + 0x04)
-            self.offset_to_animations_header = readUInt32(data, self.header_size + 0x08)
-            self.offset_to_image = readUInt32(data, self.header_size + 0x0C)
-            self.image_width = readUInt32(data, self.header_size + 0x10)
-            self.image_height = readUInt32(data, self.header_size + 0x14)
-            self.bitdepth = readUInt32(data, self.header_size + 0x18)
+            (_, _,
+             self.offset_to_frames_header,
+             self.offset_to_animations_header,
+             self.offset_to_image,
+             self.image_width,
+             self.image_height,
+             self.bitdepth) = HEADER_16.unpack_from(data, self.header_size)
         else:
             self.bits = 32
-            num_animations = readUInt32(data, self.header_size + 0x04) # I have no idea why they do this, it's the dumbest thing ever
-            self.offset_to_frames_header = readUInt32(data, self.header_size + 4 + 0x04)
-            self.offset_to_animations_header = readUInt32(data, self.header_size + 4 + 0x08)
-            self.offset_to_image = readUInt32(data, self.header_size + 4 + 0x0C)
-            self.image_width = readUInt32(data, self.header_size + 4 + 0x10)
-            self.image_height = readUInt32(data, self.header_size + 4 + 0x14)
-            self.bitdepth = readUInt32(data, self.header_size + 4 + 0x18)
+            ## I have no idea why they do this, it's the dumbest thing ever
+            (_, _,
+             num_animations,
+             self.offset_to_frames_header,
+             self.offset_to_animations_header,
+             self.offset_to_image,
+             self.image_width,
+             self.image_height,
+             self.bitdepth) = HEADER_32.unpack_from(data, self.header_size)
 
         # header_size_img_specs = offset_to_frames_header - 8
         # header_size_frames = offset_to_animations_header - offset_to_frames_header
         # header_size_animations = header_size - offset_to_animations_header
 
+        frame_headers = [FRAME_HEADER.unpack_from(data, self.offset_to_frames_header + i_f*FRAME_HEADER.size) for i_f in range(num_frames)]
+
         self.frame_image_data = []
-        for i_f in range(num_frames):
+        for i_f, (count, offset_to_img_spec) in enumerate(frame_headers):
             self.frame_image_data.append(FrameImageData())
             fid = self.frame_image_data[-1]
-            fid.count = readUInt32(data, self.offset_to_frames_header + i_f*8 + 0x00)
+            fid.count = count
             fid.frame_num = i_f
 
-            offset_to_img_spec = readUInt32(data, self.offset_to_frames_header + i_f*8 + 0x04)
             if (self.offset_to_image_specifications == 0) or (offset_to_img_spec < self.offset_to_image_specifications):
                 self.offset_to_image_specifications = offset_to_img_spec
 
             if i_f < num_frames-1:
-                offset_to_next_img_spec = readUInt32(data, self.offset_to_frames_header + (i_f+1)*8 + 0x04)
+                offset_to_next_img_spec = frame_headers[i_f+1][1]
             else:
                 offset_to_next_img_spec = self.offset_to_frames_header
             size_of_img_spec = offset_to_next_img_spec - offset_to_img_spec #32*fid.count + 8*int((fid.count + 3)/4)
 
             ## Create ImageSpecifications
+            (unknown1, unknown2, unknown3,
+             left, top, right, bottom,
+             start_x, start_y, start_rotation, start_scale_x, start_scale_y,
+             end_x, end_y, end_rotation, end_scale_x, end_scale_y) = IMAGE_SPECIFICATIONS.unpack_from(data, offset_to_img_spec)
+
             fid.img_specs = ImageSpecifications()
             img_spec = fid.img_specs
-            img_spec.unknown1 = readInt16(data, offset_to_img_spec + 0x00)
-            img_spec.unknown2 = readInt16(data, offset_to_img_spec + 0x02)
-            img_spec.unknown3 = readInt16(data, offset_to_img_spec + 0x04)
-            img_spec.crop_rect = Rect(
-                left = readUInt16(data, offset_to_img_spec + 0x06),
-                top = readUInt16(data, offset_to_img_spec + 0x08),
-                right = readUInt16(data, offset_to_img_spec + 0x0A),
-                bottom = readUInt16(data, offset_to_img_spec + 0x0C),
-            )
+            img_spec.unknown1 = unknown1
+            img_spec.unknown2 = unknown2
+            img_spec.unknown3 = unknown3
+            img_spec.crop_rect = Rect(left = left, top = top, right = right, bottom = bottom)
             ## Start transform
             img_spec.start_transform = ImageSpecificationsTransform()
-            img_spec.start_transform.offset = Vector2(
-                x = readInt16(data, offset_to_img_spec + 0x0E),
-                y = readInt16(data, offset_to_img_spec + 0x10),
-            )
-            img_spec.start_transform.rotation = readInt16(data, offset_to_img_spec + 0x12)
-            img_spec.start_transform.scale = Vector2(
-                x = readUInt16(data, offset_to_img_spec + 0x14),
-                y = readUInt16(data, offset_to_img_spec + 0x16),
-            )
+            img_spec.start_transform.offset = Vector2(x = start_x, y = start_y)
+            img_spec.start_transform.rotation = start_rotation
+            img_spec.start_transform.scale = Vector2(x = start_scale_x, y = start_scale_y)
             ## End transform
             img_spec.end_transform = ImageSpecificationsTransform()
-            img_spec.end_transform.offset = Vector2(
-                x = readInt16(data, offset_to_img_spec + 0x18),
-                y = readInt16(data, offset_to_img_spec + 0x1A),
-            )
-            img_spec.end_transform.rotation = readInt16(data, offset_to_img_spec + 0x1C)
-            img_spec.end_transform.scale = Vector2(
-                x = readUInt16(data, offset_to_img_spec + 0x1E),
-                y = readUInt16(data, offset_to_img_spec + 0x20),
-            )
+            img_spec.end_transform.offset = Vector2(x = end_x, y = end_y)
+            img_spec.end_transform.rotation = end_rotation
+            img_spec.end_transform.scale = Vector2(x = end_scale_x, y = end_scale_y)
 
-            img_spec.unknown_remaining = data[offset_to_img_spec + 0x22 : offset_to_img_spec + size_of_img_spec]
+            img_spec.unknown_remaining = bytes(data[offset_to_img_spec + IMAGE_SPECIFICATIONS.size : offset_to_img_spec + size_of_img_spec])
 
-        self.offset_to_frame_data = readUInt32(data, self.offset_to_animations_header + 0x04)
+        self.offset_to_frame_data = UINT32.unpack_from(data, self.offset_to_animations_header + 0x04)[0]
+
+        frame_timing = FRAME_TIMING_16 if self.bits == 16 else FRAME_TIMING_32
 
         for i_a in range(num_animations):
-            offset_animation = self.offset_to_animations_header + i_a*16
+            offset_animation = self.offset_to_animations_header + i_a*ANIMATION.size
             self.animations.append(Animation())
             anim = self.animations[-1]
-            num_aniframes = readUInt16(data, offset_animation + 0x00)
-            anim.animation_duration = readUInt16(data, offset_animation + 0x02)
-            offset_to_frame_data = readUInt32(data, offset_animation + 0x04)
-            num_unknown_transforms = readUInt32(data, offset_animation + 0x08)
-            offset_to_transform = readUInt32(data, offset_animation + 0x0C)
+            (num_aniframes,
+             anim.animation_duration,
+             offset_to_frame_data,
+             num_unknown_transforms,
+             offset_to_transform) = ANIMATION.unpack_from(data, offset_animation)
             unknown_transforms = []
 
             ## CHECK: This is a weird exception we have to make. A "zero frame" animation has a single "-1" frame. It may have some transform though
@@ -168,24 +136,13 @@ class PackedImageInfo:
             for idx in range(num_unknown_transforms):
                 ## I'm not entirely sure what this section is. Each frame is 4 points that can be positive or negative values.
                 ## If I had to guess, it's probably some kind of transform like shearing to give images a "swaying" animation
-                tf = Vector4(
-                    readInt16(data, offset_to_transform + idx*8 + 0x00),
-                    readInt16(data, offset_to_transform + idx*8 + 0x02),
-                    readInt16(data, offset_to_transform + idx*8 + 0x04),
-                    readInt16(data, offset_to_transform + idx*8 + 0x06),
-                )
+                tf = Vector4(*UNKNOWN_TRANSFORM.unpack_from(data, offset_to_transform + idx*UNKNOWN_TRANSFORM.size))
                 unknown_transforms.append(tf)
 
 
             for i_ftd in range(num_aniframes):
-                if self.bits == 16:
-                    ## 16 bit values
-                    frame_num = readInt16(data, offset_to_frame_data + i_ftd*4 + 0x00)
-                    frame_duration = readUInt16(data, offset_to_frame_data + i_ftd*4 + 0x02)
-                else:
-                    ## 32 bit values
-                    frame_num = readInt32(data, offset_to_frame_data + i_ftd*8 + 0x00)
-                    frame_duration = readUInt32(data, offset_to_frame_data + i_ftd*8 + 0x04)
+                ## 16 or 32 bit values
+                frame_num, frame_duration = frame_timing.unpack_from(data, offset_to_frame_data + i_ftd*frame_timing.size)
 
                 # if frame_num == 0xFFFF:
                 #     ## I have no idea why this happens but it does.
@@ -212,176 +169,147 @@ class PackedImageInfo:
                 #     self.frame_image_data[frame_num].accessed += 1
 
     def rebuild(self) -> bytes:
-        final_output = bytes()
+        frame_timing = FRAME_TIMING_16 if self.bits == 16 else FRAME_TIMING_32
+
+        ############
+        ## Work out the size of every section first, so the output is only allocated once
+        ############
+        ## The image specifications start after zero padding, in 4 byte steps
+        size_start = HEADER_START.size
+        if self.offset_to_image_specifications > size_start:
+            size_start += padded_size(self.offset_to_image_specifications - size_start, k=4)
 
-        final_output += createUInt32(self.header_size)
-        final_output += createUInt32(self.img_data_offset_qqq)
+        sizes_img_specs = [IMAGE_SPECIFICATIONS.size + len(fid.img_specs.unknown_remaining) for fid in self.frame_image_data]
 
-        while (self.offset_to_image_specifications > len(final_output)):
-            final_output += createInt32(0)
+        size_second_header = FRAME_HEADER.size * len(self.frame_image_data)
+        if self.bits == 32:
+            size_second_header = padded_size(size_second_header, k=16)
 
-        # if self.bits == 32:
-        #     final_output += createInt32(0)
-        #     final_output += createInt32(0)
+        ## Frame timing data is padded to an even number of frames
+        sizes_frame_timing_data = [frame_timing.size * (len(anim.frame_timing_data) + len(anim.frame_timing_data)%2) for anim in self.animations]
+
+        ## Only the transforms of the first frame are written
+        unknown_transforms = []
+        for anim in self.animations:
+            if len(anim.frame_timing_data) > 0:
+                unknown_transforms.append(anim.frame_timing_data[0].unknown_transforms)
+            else:
+                unknown_transforms.append([])
+        size_unknown_transforms = UNKNOWN_TRANSFORM.size * sum(len(uts) for uts in unknown_transforms)
+
+        header = HEADER_16 if self.bits == 16 else HEADER_32
+
+        final_output = bytearray(
+            size_start
+            + sum(sizes_img_specs)
+            + size_second_header
+            + sum(sizes_frame_timing_data)
+            + size_unknown_transforms
+            + ANIMATION.size * len(self.animations)
+            + header.size
+        )
+
+        HEADER_START.pack_into(final_output, 0, self.header_size, self.img_data_offset_qqq)
+        pos = size_start
 
         ############
         ## Pack the image specifications bytes
         ############
-        byte_list_img_specs: List[bytes] = []
-
         for fid in self.frame_image_data:
-            temp_bytes = bytes()
             specs: ImageSpecifications = fid.img_specs
-            temp_bytes += createInt16(specs.unknown1)
-            temp_bytes += createInt16(specs.unknown2)
-            temp_bytes += createInt16(specs.unknown3)
-            temp_bytes += createInt16(specs.crop_rect.left)
-            temp_bytes += createInt16(specs.crop_rect.top)
-            temp_bytes += createInt16(specs.crop_rect.right)
-            temp_bytes += createInt16(specs.crop_rect.bottom)
-            temp_bytes += createInt16(specs.start_transform.offset.x)
-            temp_bytes += createInt16(specs.start_transform.offset.y)
-            temp_bytes += createInt16(specs.start_transform.rotation)
-            temp_bytes += createInt16(specs.start_transform.scale.x)
-            temp_bytes += createInt16(specs.start_transform.scale.y)
-            temp_bytes += createInt16(specs.end_transform.offset.x)
-            temp_bytes += createInt16(specs.end_transform.offset.y)
-            temp_bytes += createInt16(specs.end_transform.rotation)
-            temp_bytes += createInt16(specs.end_transform.scale.x)
-            temp_bytes += createInt16(specs.end_transform.scale.y)
-            temp_bytes += specs.unknown_remaining
-
-            # if self.bits == 32:
-            #     bytes_to_add = 16 - len(temp_bytes)%16
-            #     if bytes_to_add != 16:
-            #         temp_bytes += b'\x00'*bytes_to_add
-
-            byte_list_img_specs.append(temp_bytes)
-
-        for b in byte_list_img_specs:
-            final_output += b
+            IMAGE_SPECIFICATIONS_PACK.pack_into(final_output, pos,
+                specs.unknown1,
+                specs.unknown2,
+                specs.unknown3,
+                specs.crop_rect.left,
+                specs.crop_rect.top,
+                specs.crop_rect.right,
+                specs.crop_rect.bottom,
+                specs.start_transform.offset.x,
+                specs.start_transform.offset.y,
+                specs.start_transform.rotation,
+                specs.start_transform.scale.x,
+                specs.start_transform.scale.y,
+                specs.end_transform.offset.x,
+                specs.end_transform.offset.y,
+                specs.end_transform.rotation,
+                specs.end_transform.scale.x,
+                specs.end_transform.scale.y,
+            )
+            pos += IMAGE_SPECIFICATIONS_PACK.size
+            final_output[pos : pos + len(specs.unknown_remaining)] = specs.unknown_remaining
+            pos += len(specs.unknown_remaining)
 
         ############
         ## Second Header
         ############
-        output_second_header = bytes()
         offset = self.offset_to_image_specifications
-        # if self.bits == 16:
-        #     offset = 0x08
-        # else:
-        #     offset = 0x10
-
         for idx, fid in enumerate(self.frame_image_data):
-            output_second_header += createInt32(fid.count)
-            output_second_header += createInt32(offset)
-            offset += len(byte_list_img_specs[idx])
-
-        if self.bits == 32:
-            bytes_to_add = 16 - len(output_second_header)%16
-            if bytes_to_add != 16:
-                output_second_header += b'\x00'*bytes_to_add
-
-        final_output += output_second_header
+            FRAME_HEADER.pack_into(final_output, pos + idx*FRAME_HEADER.size, fid.count, offset)
+            offset += sizes_img_specs[idx]
+        pos += size_second_header
 
         ############
         ## Animation timing data
         ############
+        for anim, size in zip(self.animations, sizes_frame_timing_data):
+            for idx_ftd, ftd in enumerate(anim.frame_timing_data):
+                frame_timing.pack_into(final_output, pos + idx_ftd*frame_timing.size, ftd.frame_num, ftd.frame_duration)
+            pos += size
 
-        byte_list_frame_timing_data: List[bytes] = []
-        byte_list_unknown_transforms: List[bytes] = []
-        for idx_anim, anim in enumerate(self.animations):
-            temp_bytes_timing = bytes()# TODO + createInt16(-1)
-            if self.bits == 16:
-                for idx_ftd, ftd in enumerate(anim.frame_timing_data):
-                    temp_bytes_timing += createInt16(ftd.frame_num)
-                    temp_bytes_timing += createInt16(ftd.frame_duration)
-
-                if len(anim.frame_timing_data)%2 == 1:
-                    ## Pad so it's 16 bits long
-                    temp_bytes_timing += createInt32(0)
-            else:
-                for idx_ftd, ftd in enumerate(anim.frame_timing_data):
-                    temp_bytes_timing += createInt32(ftd.frame_num)
-                    temp_bytes_timing += createInt32(ftd.frame_duration)
-
-                if len(anim.frame_timing_data)%2 == 1:
-                    ## Pad so it's 32 bits long
-                    temp_bytes_timing += createInt32(0) + createInt32(0)
-
-            byte_list_frame_timing_data.append(temp_bytes_timing)
-
-            ## Unknown transforms
-            temp_bytes_transform = bytes()
-            if len(anim.frame_timing_data) > 0:
-                ftd = anim.frame_timing_data[0]
-
-                # for idx_ftd, ftd in enumerate(anim.frame_timing_data):
-                for ut in ftd.unknown_transforms:
-                    temp_bytes_transform += createInt16(ut.x) + createInt16(ut.y) + createInt16(ut.z) + createInt16(ut.w)
-                if len(temp_bytes_transform) > 0:
-                    byte_list_unknown_transforms.append(temp_bytes_transform)
-
-        offset_unknown_transforms = len(output_second_header) #sum([len(x) for x in byte_list_frame_timing_data])
+        offset_unknown_transforms = size_second_header + sum(sizes_frame_timing_data)
 
-        for b in byte_list_frame_timing_data:
-            offset_unknown_transforms += len(b)
-            final_output += b
-        for b in byte_list_unknown_transforms:
-            final_output += b
+        for uts in unknown_transforms:
+            for ut in uts:
+                UNKNOWN_TRANSFORM.pack_into(final_output, pos, ut.x, ut.y, ut.z, ut.w)
+                pos += UNKNOWN_TRANSFORM.size
 
         ############
         ## Animations data
         ############
         offset_frame_timing_data = 0
 
-        idx_ut = 0
-        for idx_anim, anim in enumerate(self.animations):
+        for anim, size, uts in zip(self.animations, sizes_frame_timing_data, unknown_transforms):
             if len(anim.frame_timing_data) == 1 and anim.frame_timing_data[-1].frame_num == -1:
                 num_aniframes = 0
             else:
                 num_aniframes = len(anim.frame_timing_data)
 
-            final_output += createInt16(num_aniframes)
-            final_output += createInt16(anim.animation_duration)
-            final_output += createInt32(self.offset_to_frame_data + offset_frame_timing_data)
-
-            if self.bits == 16:
-                offset_frame_timing_data += 0x08 * int((len(anim.frame_timing_data)+1)/2)
-            else:
-                offset_frame_timing_data += 0x10 * int((len(anim.frame_timing_data)+1)/2)
-
             ## Handle Unknown transform
-            num_ut = 0
-            if len(anim.frame_timing_data) > 0:
-                ftd = anim.frame_timing_data[0]
-                # for idx_ftd, ftd in enumerate(anim.frame_timing_data):
-                num_ut += len(ftd.unknown_transforms)
-
-            final_output += createInt32(num_ut)
+            num_ut = len(uts)
             if num_ut == 0:
-                final_output += createInt32(0)
+                offset_to_transform = 0
             else:
-                final_output += createInt32(self.offset_to_frames_header + offset_unknown_transforms)
-                ut = byte_list_unknown_transforms[idx_ut]
-                offset_unknown_transforms += len(ut)
-                idx_ut += 1
+                offset_to_transform = self.offset_to_frames_header + offset_unknown_transforms
+                offset_unknown_transforms += UNKNOWN_TRANSFORM.size * num_ut
+
+            ANIMATION.pack_into(final_output, pos,
+                num_aniframes,
+                anim.animation_duration,
+                self.offset_to_frame_data + offset_frame_timing_data,
+                num_ut,
+                offset_to_transform,
+            )
+            pos += ANIMATION.size
+            offset_frame_timing_data += size
 
-        num_frames = createInt16(len(self.frame_image_data))
         if self.bits == 16:
-            num_animations = createInt16(len(self.animations))
+            num_animations = (len(self.animations),)
         else:
-            num_animations = createInt16(0) + createInt32(len(self.animations))
-
-        final_output += createInt16(len(self.frame_image_data))
-        final_output += num_animations
-        final_output += createInt32(self.offset_to_frames_header) #Offset to frame headers
-        final_output += createInt32(self.offset_to_animations_header) #Offset to displayable headers
-        final_output += createInt32(self.offset_to_image) #Offset to img data
-        final_output += createUInt32(self.image_width)
-        final_output += createUInt32(self.image_height)
-        final_output += createUInt32(self.bitdepth)
-
-        return final_output
+            num_animations = (0, len(self.animations))
+
+        header.pack_into(final_output, pos,
+            len(self.frame_image_data),
+            *num_animations,
+            self.offset_to_frames_header, #Offset to frame headers
+            self.offset_to_animations_header, #Offset to displayable headers
+            self.offset_to_image, #Offset to img data
+            self.image_width,
+            self.image_height,
+            self.bitdepth,
+        )
+
+        return bytes(final_output)
 
 
     def serialize(self):
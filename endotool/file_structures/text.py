@@ -1,10 +1,13 @@
 import struct
-from typing import List
+from typing import List, Dict, Tuple
 from io import TextIOWrapper
 import os
+import json
+import hashlib
 
 from endotool import jis208
-from endotool.utils import pad_to_nearest
+from endotool.utils import pad_to_nearest, padded_size
+from endotool.exo import ExoArchive
 
 
 class TextEntry:
@@ -12,11 +15,31 @@ class TextEntry:
         self.elf_address : int = 0
         self.item_num : int = 0
         self.text_address : int = 0
-        self.text : str = ""
-        self.transform_ascii : bool = False
+        self._text : str = ""
+        self._transform_ascii : bool = False
+        self._byte_string : bytes = None
         
         self.connected_entries : List['TextEntry'] = []
 
+    ## The encoded text is cached until the text or the encoding changes
+    @property
+    def text(self) -> str:
+        return self._text
+
+    @text.setter
+    def text(self, value : str):
+        self._text = value
+        self._byte_string = None
+
+    @property
+    def transform_ascii(self) -> bool:
+        return self._transform_ascii
+
+    @transform_ascii.setter
+    def transform_ascii(self, value : bool):
+        self._transform_ascii = value
+        self._byte_string = None
+
     @property
     def primary_entry(self):
         return self.connected_entries[0]
@@ -27,10 +50,12 @@ class TextEntry:
     
     @property
     def byte_string(self) -> bytes:
-        rv = jis208.stringToHex(self.text, transform_ascii=self.transform_ascii)
-        ## Make sure the string is null-terminated, then pad it
-        # return rv + bytes(1)
-        return pad_to_nearest(rv + bytes(1), k=8)
+        if self._byte_string is None:
+            rv = jis208.stringToHex(self.text, transform_ascii=self.transform_ascii)
+            ## Make sure the string is null-terminated, then pad it
+            # return rv + bytes(1)
+            self._byte_string = pad_to_nearest(rv + bytes(1), k=8)
+        return self._byte_string
 
 class ExoScriptBlock:
     """
@@ -69,6 +94,9 @@ class ExoScriptBlock:
         else:
             self.text_entries = text_entries
 
+        ## Entries by item number
+        self.entry_index : Dict[int, TextEntry] = {entry.item_num: entry for entry in self.text_entries}
+
         ## ELF data
         ## <exo_size> <zeros> <elf_pointer> <zeros>
         self.exo_size : int = exo_size # The size of the EXO block according to the ELF
@@ -85,38 +113,46 @@ class ExoScriptBlock:
     @property
     def text_size(self):
         return self.offset_to_textoffsets - 0x20
+
+    def getEntry(self, item_num : int) -> TextEntry:
+        return self.entry_index.get(item_num)
+
+    def textHash(self) -> str:
+        ## Identifies the texts toBinary would write for this block
+        texts = [(entry.item_num, entry.text, entry.transform_ascii) for entry in self.text_entries]
+        return hashlib.sha1(json.dumps(texts).encode('utf-8')).hexdigest()
     
-    def fromBinary(self, exo_file : TextIOWrapper):
+    def fromBinary(self, exo : ExoArchive):
         if self.exo_address == 0:
             raise AttributeError("exo_address must be non-zero before calling unpack. Set the value in the block constructor.")
-        
-        exo_file.seek(self.exo_address)
 
         ## Grab the header data
         self.text_entries : List[TextEntry] = []
-        self.block_size = struct.unpack('<I', exo_file.read(4))[0]
-        self.offset_to_textoffsets = struct.unpack('<I', exo_file.read(4))[0]
-        self.unknown = struct.unpack('<I', exo_file.read(4))[0]
+        self.entry_index = {}
+        self.block_size = exo.u32(self.exo_address)
+        self.offset_to_textoffsets = exo.u32(self.exo_address + 4)
+        self.unknown = exo.u32(self.exo_address + 8)
+
+        block = exo.block(self.exo_address, max(self.exo_size, self.block_size))
 
         ## Grab the offset data
-        exo_file.seek(self.exo_address + self.offset_to_textoffsets)
-        self.offset_section = exo_file.read(self.block_size - self.offset_to_textoffsets)
+        self.offset_section = bytes(block[self.offset_to_textoffsets : self.block_size])
 
         ## Grab the script data
-        exo_file.seek(self.exo_address + self.block_size)
-        self.script_section = exo_file.read(self.exo_size - self.block_size)
+        self.script_section = bytes(block[self.block_size : self.exo_size])
 
         ## Grab the text data
-        exo_file.seek(self.exo_address + self.offset_to_textoffsets)
-        current_pos = exo_file.tell()
+        current_pos = self.offset_to_textoffsets
         current_item = 0
 
+        ## First entry found at each text address
+        address_index : Dict[int, TextEntry] = {}
+
         while current_item < (self.block_size - self.offset_to_textoffsets)/4:
-            exo_file.seek(current_pos)
-            text_pointer = struct.unpack('<I', exo_file.read(4))[0]
+            text_pointer = struct.unpack_from('<I', block, current_pos)[0]
             if text_pointer == 0:
                 break
-            
+
             ## Only create entries for text inside the actual block
             ## This is because some "text" is in the script portion
             ## (eg. "PAD_OFF", "PAD_ON")
@@ -126,32 +162,28 @@ class ExoScriptBlock:
                 entry.text_address = text_pointer #current_pos - self.exo_address
 
                 ## Make sure this entry wasn't already found before (pointing to same location)
-                found_entry : TextEntry = None
-                for entry2 in self.text_entries:
-                    if entry.text_address == entry2.text_address:
-                        found_entry = entry2
-                        break
+                found_entry : TextEntry = address_index.get(entry.text_address)
 
                 if found_entry is None:
-                    exo_file.seek(self.exo_address + text_pointer)
-                    entry.text = jis208.decode(exo_file)
+                    entry.text, _ = jis208.decodeBuffer(block, text_pointer)
                     entry.connected_entries.append(entry)
-                    self.text_entries.append(entry)
+                    address_index[entry.text_address] = entry
                 else:
                     entry.connected_entries = found_entry.connected_entries
                     entry.connected_entries.append(entry)
-                    self.text_entries.append(entry)
+
+                self.text_entries.append(entry)
+                self.entry_index[entry.item_num] = entry
 
             current_pos += 4
             current_item += 1
-        pass
-    
+
     def toBinary(self) -> bytes:
         ## Create the primary text section as well as the
         ## secondary text section that's appended to the end
         ## of the block if it doesn't fit in the normal block
-        text_section = b""
-        text_section2 = b""
+        text_section = bytearray()
+        text_section2 = bytearray()
         is_primary_section = True
         prev_offset = 0x20
 
@@ -175,50 +207,47 @@ class ExoScriptBlock:
                 text_section2 += byte_string
             
             entry.text_address = prev_offset
-            prev_offset += len(entry.byte_string)
+            prev_offset += len(byte_string)
 
         ## Modify the offset section
         ## The idea is to preserve any weird references in the original
         ## that point to something in the script section
+        offset_section = bytearray(self.offset_section)
         for entry in self.text_entries:
-            idx = entry.item_num*4
-
-            self.offset_section = self.offset_section[:idx] + \
-                                  struct.pack("<I", entry.primary_entry.text_address) + \
-                                  self.offset_section[idx+4:]
+            struct.pack_into("<I", offset_section, entry.item_num*4, entry.primary_entry.text_address)
+        self.offset_section = bytes(offset_section)
         
         ###########
         ## Finally, write the output block
         ###########
         
         ## Header
-        rv = b""
-        rv += struct.pack("<I", self.block_size)
-        rv += struct.pack("<I", self.offset_to_textoffsets)
-        rv += struct.pack("<I", self.unknown)
-        rv += struct.pack("IIIII", 0x00, 0x00, 0x00, 0x00, 0x00)
+        rv = bytearray(struct.pack("<III", self.block_size, self.offset_to_textoffsets, self.unknown))
+        rv += bytes(5*4)
 
         ## Remaining sections
         if self.text_size > 0:
-            rv += pad_to_nearest(text_section, k=self.text_size)
+            rv += text_section
+            rv += bytes(padded_size(len(text_section), k=self.text_size) - len(text_section))
         rv += self.offset_section
         rv += self.script_section
-        rv += pad_to_nearest(text_section2, k=16)
+        rv += text_section2
+        rv += bytes(padded_size(len(text_section2), k=16) - len(text_section2))
 
         ## Finally pad out the end a bit if needed
         self.exo_size = len(rv)
-        rv = pad_to_nearest(rv, k=2048)
+        rv += bytes(padded_size(len(rv), k=2048) - len(rv))
 
-        return rv
+        return bytes(rv)
 
 class ElfTextStringBlock:
     def __init__(self, offset=0, end=0) -> None:
         self.offset : int = offset
         self.size : int = end-offset
-        self.data : bytes = b""
+        self.data : bytearray = bytearray()
     
     def canFit(self, byte_string: bytes):
-        return len(self.data + byte_string) <= self.size
+        return len(self.data) + len(byte_string) <= self.size
     
     def addByteString(self, byte_string: bytes) -> int:
         ptr = self.offset + len(self.data)
@@ -226,7 +255,7 @@ class ElfTextStringBlock:
         return ptr
 
     def getData(self):
-        return pad_to_nearest(self.data, self.size)
+        return pad_to_nearest(bytes(self.data), self.size)
 
 class ElfTextManager:
     ELF_OFFSET = -0x0163F000
@@ -272,27 +301,32 @@ class ElfTextManager:
         ]
 
         self.text_entries : List[TextEntry] = []
-    
+
+        ## Entries by (pointer table address, item number)
+        self.entry_index : Dict[Tuple[int, int], TextEntry] = {}
+
+    def getEntry(self, elf_address : int, item_num : int) -> TextEntry:
+        return self.entry_index.get((elf_address, item_num))
+
     def readFromFile(self, elf_file : TextIOWrapper):
-        elf_file.seek(0, os.SEEK_END)
-        elfsize = elf_file.tell()
+        elf_file.seek(0)
+        elf_data = elf_file.read()
+        elfsize = len(elf_data)
 
         for i in self.ELF_POINTERS:
             elf_pointer = i['pointer']
             current_pos = elf_pointer
             current_item = 0
             while current_item*4 < i['size']:
-                elf_file.seek(current_pos)
-                text_pointer = struct.unpack('<I', elf_file.read(4))[0] + self.ELF_OFFSET
-                current_pos = elf_file.tell()
+                text_pointer = struct.unpack_from('<I', elf_data, current_pos)[0] + self.ELF_OFFSET
+                current_pos += 4
                 current_item += 1
 
                 if text_pointer < 0x0 or text_pointer >= elfsize:
                     # not a valid pointer
                     continue
 
-                elf_file.seek(text_pointer)
-                text = jis208.decode(elf_file)
+                text, _ = jis208.decodeBuffer(elf_data, text_pointer)
 
                 entry = TextEntry()
                 entry.elf_address = elf_pointer
@@ -301,6 +335,7 @@ class ElfTextManager:
                 entry.text = text
 
                 self.text_entries.append(entry)
+                self.entry_index[(entry.elf_address, entry.item_num)] = entry
 
     def writeToFile(self, elf_file : TextIOWrapper):
         curr_string_block_idx = 0
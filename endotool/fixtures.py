@@ -0,0 +1,280 @@
+import os
+import struct
+import random
+from typing import List, Tuple
+
+from endotool import font, scripts, images, jis208
+from endotool.exo import SECTOR_SIZE
+from endotool.utils import padded_size
+from endotool.file_structures.text import ElfTextManager
+from endotool.file_structures.images import (PackedImageInfo, FrameImageData, ImageSpecifications, ImageSpecificationsTransform,
+    Animation, FrameTimingData, Rect, Vector2, Vector4, IMAGE_SPECIFICATIONS, FRAME_HEADER, ANIMATION, HEADER_16, HEADER_32)
+
+ELF_SIZE = 0x350000
+TEXTURE_SIZES = [(64, 32, 8), (32, 16, 24), (128, 64, 8), (16, 16, 24)]
+
+## Characters used for random text. Only table entries that are actually assigned.
+ASCII_CHARS = b'abcdefgXYZ 0129.!?'
+JIS_INDICES = [idx for idx, code in enumerate(jis208.table) if code != 0]
+
+
+class Fixture:
+    """
+    Synthetic ELF and EXO.BIN files laid out like the real game files, for
+    benchmarking without the game. The contents are random.
+    """
+
+    def __init__(self, seed : int = 0) -> None:
+        self.rng = random.Random(seed)
+        self.elf = bytearray(ELF_SIZE)
+        self.exo = bytearray()
+
+        self.num_textures = 0
+        self.texture_bytes = 0
+        self.num_blocks = 0
+        self.block_bytes = 0
+        self.num_elf_texts = 0
+
+    def save(self, dir_output : str) -> Tuple[str, str]:
+        os.makedirs(dir_output, exist_ok=True)
+        fname_elf = os.path.join(dir_output, 'SLPM_620.47')
+        fname_exo = os.path.join(dir_output, 'EXO.BIN')
+        with open(fname_elf, 'wb') as f:
+            f.write(self.elf)
+        with open(fname_exo, 'wb') as f:
+            f.write(self.exo)
+        return fname_elf, fname_exo
+
+    def align_exo(self) -> None:
+        self.exo += bytes(padded_size(len(self.exo), SECTOR_SIZE) - len(self.exo))
+
+    ###############
+    ## Font
+    ###############
+    def add_font(self) -> None:
+        rng = self.rng
+        ## 15 random colors and white
+        colors = sorted(rng.sample(range(0x80000000, 0x80FFFFFF), 15)) + [0x80FFFFFF]
+        self.elf[font.OFFSET : font.OFFSET + font.PALETTE_SIZE] = struct.pack('<16I', *colors)
+
+        ## Mostly empty glyphs, like the real font
+        size = font.WIDTH * font.HEIGHT * font.BITDEPTH // 8
+        pixels = bytes(rng.choice((0x00, 0x00, 0x00, 0x11, 0x1F, 0xF1, 0xFF)) for _ in range(4096))
+        offset = font.OFFSET + font.PALETTE_SIZE
+        for pos in range(0, size, len(pixels)):
+            self.elf[offset + pos : offset + min(pos + len(pixels), size)] = pixels[: size - pos]
+
+    ###############
+    ## Textures
+    ###############
+    def texture_header(self, width : int, height : int, bitdepth : int, bits : int, num_frames : int, num_animations : int) -> bytes:
+        rng = self.rng
+        info = PackedImageInfo()
+        info.bits = bits
+        info.image_width = width
+        info.image_height = height
+        info.bitdepth = bitdepth
+        info.header_size = 0
+        info.offset_to_image_specifications = 8 if bits == 16 else 0x10
+
+        for i_f in range(num_frames):
+            fid = FrameImageData()
+            fid.count = 1
+            fid.frame_num = i_f
+            fid.img_specs = ImageSpecifications()
+            specs = fid.img_specs
+            specs.unknown1, specs.unknown2, specs.unknown3 = (rng.randrange(-5, 5) for _ in range(3))
+            specs.crop_rect = Rect(left = 0, top = 0, right = width, bottom = height)
+            for name in ('start_transform', 'end_transform'):
+                transform = ImageSpecificationsTransform()
+                transform.offset = Vector2(x = rng.randrange(-50, 50), y = rng.randrange(-50, 50))
+                transform.rotation = rng.randrange(-360, 360)
+                transform.scale = Vector2(x = 4096, y = 4096)
+                setattr(specs, name, transform)
+            specs.unknown_remaining = rng.randbytes(6)
+            info.frame_image_data.append(fid)
+
+        for i_a in range(num_animations):
+            anim = Animation()
+            anim.animation_duration = rng.randrange(1, 100)
+            unknown_transforms = []
+            if i_a % 2 == 0:
+                unknown_transforms = [Vector4(*(rng.randrange(-100, 100) for _ in range(4))) for _ in range(rng.randrange(1, 3))]
+            for _ in range(rng.randrange(1, 4)):
+                ftd = FrameTimingData()
+                ftd.frame_num = rng.randrange(num_frames)
+                ftd.frame_duration = rng.randrange(1, 30)
+                ftd.unknown_transforms = unknown_transforms
+                anim.frame_timing_data.append(ftd)
+            info.animations.append(anim)
+
+        ## Build once to find where each section ends up, then again with the offsets filled in
+        data = info.rebuild()
+        size_img_specs = sum(IMAGE_SPECIFICATIONS.size + len(fid.img_specs.unknown_remaining) for fid in info.frame_image_data)
+        info.offset_to_frames_header = info.offset_to_image_specifications + size_img_specs
+        info.header_size = len(data) - (HEADER_16 if bits == 16 else HEADER_32).size
+        info.offset_to_animations_header = info.header_size - ANIMATION.size * num_animations
+        second_header = FRAME_HEADER.size * num_frames
+        if bits == 32:
+            second_header = padded_size(second_header, k=16)
+        info.offset_to_frame_data = info.offset_to_frames_header + second_header
+        info.offset_to_image = padded_size(info.header_size + 0x30, 0x80)
+        info.img_data_offset_qqq = info.offset_to_image
+
+        data = info.rebuild()
+        return data + bytes(info.offset_to_image - len(data))
+
+    def add_texture(self, width : int, height : int, bitdepth : int, bits : int = 16) -> None:
+        rng = self.rng
+        self.exo += self.texture_header(width, height, bitdepth, bits, rng.randrange(1, 4), rng.randrange(1, 4))
+
+        ## The alpha channel only goes up to 0x80
+        if bitdepth == 8:
+            palette = bytearray(rng.randbytes(images.PALETTE_SIZE))
+            palette[3::4] = bytes(rng.choice((0, 0x80, rng.randrange(0x81))) for _ in range(256))
+            data = bytes(palette) + rng.randbytes(width * height)
+        else:
+            data = bytearray(rng.randbytes(width * height * 4))
+            data[3::4] = bytes(rng.choice((0, 0x80, rng.randrange(0x81))) for _ in range(width * height))
+        self.exo += data
+
+        self.num_textures += 1
+        self.texture_bytes += len(data)
+
+    def add_textures(self, texture_end : int, texture_sizes : List[Tuple[int, int, int]] = TEXTURE_SIZES) -> None:
+        """
+        Fill EXO.BIN with textures up to texture_end, the same way images.scan_textures walks it
+        """
+        i = 0
+        while len(self.exo) < texture_end:
+            if len(self.exo) in images.UNKNOWN_SIZES:
+                size = images.UNKNOWN_SIZES[len(self.exo)]
+                width, height, bitdepth = size['width'], size['height'], size['bitdepth']
+            else:
+                width, height, bitdepth = texture_sizes[i % len(texture_sizes)]
+
+            ## Mix in some 32 bit headers
+            self.add_texture(width, height, bitdepth, bits = 32 if i % 3 == 0 else 16)
+            self.align_exo()
+            if len(self.exo) in images.SKIPPED_REGIONS:
+                self.exo += bytes(images.SKIPPED_REGIONS[len(self.exo)] - len(self.exo))
+            i += 1
+
+    ###############
+    ## Text
+    ###############
+    def random_text(self, length : int) -> bytes:
+        rng = self.rng
+        rv = bytearray()
+        for _ in range(length):
+            r = rng.random()
+            if r < 0.5:
+                idx = rng.choice(JIS_INDICES)
+                rv += bytes([idx // 94 + jis208.TABLE_OFFSET, idx % 94 + jis208.TABLE_OFFSET])
+            elif r < 0.8:
+                rv.append(rng.choice(ASCII_CHARS))
+            elif r < 0.9:
+                rv += b'\n'
+            else:
+                rv += b'%n'
+        return bytes(rv) + b'\0'
+
+    def script_block(self, num_texts : int) -> bytes:
+        rng = self.rng
+        texts = [self.random_text(rng.randrange(1, 20)) for _ in range(num_texts)]
+
+        text_section = bytearray()
+        pointers = []
+        for text in texts:
+            pointers.append(0x20 + len(text_section))
+            text_section += text + bytes(padded_size(len(text), 8) - len(text))
+        text_section += bytes(rng.choice((0, 8, 40)))
+        offset_to_textoffsets = 0x20 + len(text_section)
+
+        ## Texts can be referenced more than once
+        if num_texts > 2:
+            pointers.insert(2, pointers[0])
+
+        offsets = bytearray()
+        for pointer in pointers:
+            offsets += struct.pack('<I', pointer)
+        block_size = offset_to_textoffsets + len(offsets) + 16
+        ## A pointer into the script code, which isn't text
+        offsets += struct.pack('<I', block_size + 4)
+        offsets += bytes(block_size - offset_to_textoffsets - len(offsets))
+
+        script = rng.randbytes(rng.randrange(16, 200))
+        return struct.pack('<III5I', block_size, offset_to_textoffsets, rng.randrange(100), 0, 0, 0, 0, 0) + text_section + offsets + script
+
+    def add_script_blocks(self, num_blocks : int) -> None:
+        """
+        Append script blocks to EXO.BIN and point to them from the ELF
+        """
+        rng = self.rng
+        pointer = scripts.EXO_POINTERS
+        for i in range(num_blocks):
+            ## Leave room for the entries that are skipped
+            if pointer + 40 > scripts.EXO_POINTERS_END:
+                break
+
+            self.align_exo()
+            block = self.script_block(rng.randrange(0, 12) if i else 5)
+            exo_address = len(self.exo)
+            self.exo += block
+
+            ## Entries that aren't script blocks
+            if i % 7 == 3:
+                self.elf[pointer : pointer+8] = struct.pack('<II', 0xFFFFFFFF, 0)
+                pointer += 8
+            if i % 11 == 5:
+                self.elf[pointer : pointer+8] = struct.pack('<II', 0x100, 1)
+                pointer += 8
+
+            self.elf[pointer : pointer+16] = struct.pack('<IIII', len(block), 0, exo_address, 0)
+            pointer += 16
+
+            self.num_blocks += 1
+            self.block_bytes += len(block)
+
+        self.align_exo()
+
+    def add_elf_texts(self, num_texts : int) -> None:
+        """
+        Fill the ELF pointer tables with texts in the first free string block
+        """
+        rng = self.rng
+        string_block = ElfTextManager().string_blocks[0]
+        text_address = string_block.offset
+        text_end = string_block.offset + string_block.size
+
+        for table in ElfTextManager.ELF_POINTERS:
+            for item in range(table['size'] // 4):
+                ## Some of the pointers are left empty
+                if self.num_elf_texts >= num_texts or rng.random() < 0.2:
+                    continue
+
+                text = self.random_text(rng.randrange(1, 10))
+                if text_address + len(text) > text_end:
+                    return
+
+                self.elf[text_address : text_address + len(text)] = text
+                struct.pack_into('<I', self.elf, table['pointer'] + 4*item, text_address - ElfTextManager.ELF_OFFSET)
+                text_address += padded_size(len(text), 8)
+                self.num_elf_texts += 1
+
+
+def generate(dir_output : str, seed : int = 0, texture_end : int = 0x80000, num_blocks : int = 40, num_elf_texts : int = 200,
+             texture_sizes : List[Tuple[int, int, int]] = TEXTURE_SIZES) -> Fixture:
+    """
+    Write a synthetic SLPM_620.47 and EXO.BIN into dir_output.
+
+    Textures fill EXO.BIN up to texture_end, followed by the script blocks.
+    images.TEXTURE_END has to be set to texture_end to read it back.
+    """
+    fixture = Fixture(seed)
+    fixture.add_font()
+    fixture.add_textures(texture_end, texture_sizes)
+    fixture.add_script_blocks(num_blocks)
+    fixture.add_elf_texts(num_elf_texts)
+    fixture.fname_elf, fixture.fname_exo = fixture.save(dir_output)
+    return fixture
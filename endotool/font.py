@@ -1,13 +1,18 @@
 import subprocess
 import struct
+import sys
 import os
 import json
 import shutil
+import hashlib
+import time
 from PIL import Image
 
-from endotool import tbl
-from endotool.bmp import write_file
-from endotool.utils import read_in_chunks, check_bin, basedir
+from endotool import tbl, profiler
+from endotool.utils import check_bin, basedir, file_fingerprint
+from endotool.output import OutputFile
+from endotool.pixels import pack_4bpp, unpack_4bpp
+from endotool.progress import Progress
 
 OFFSET = 0xD890
 WIDTH = 2256
@@ -15,38 +20,165 @@ HEIGHT = 1128
 BITDEPTH = 4
 WIDTH_TABLE = 0x33D4D0
 TABLE_SIZE = 0x11A
+PALETTE_SIZE = 16*4
+GLYPH_SIZE = 24
+GLYPHS_PER_ROW = WIDTH // GLYPH_SIZE
+NUM_GLYPHS = GLYPHS_PER_ROW * (HEIGHT // GLYPH_SIZE)
+GLYPH_CACHE_SUFFIX = '.glyphs.json'
 
 def extract(fname_elf, fname_font):
     print("Extracting font image")
-    elf_file = open(fname_elf, 'rb')
-    elf_file.seek(OFFSET)
+    profiler.start('font-read')
+    with open(fname_elf, 'rb') as elf_file:
+        elf_file.seek(OFFSET)
+        data = elf_file.read(PALETTE_SIZE + WIDTH*HEIGHT*BITDEPTH//8)
+    profiler.stop('font-read', bytes_read = len(data))
 
-    write_file(elf_file, WIDTH, HEIGHT, BITDEPTH, fname_font)
+    ## The palette is stored as 0xAARRGGBB words, ie. B G R A bytes
+    palette = bytearray(16*3)
+    palette[0::3] = data[2:PALETTE_SIZE:4]
+    palette[1::3] = data[1:PALETTE_SIZE:4]
+    palette[2::3] = data[0:PALETTE_SIZE:4]
 
-    # Flip image vertically
-    im = Image.open(fname_font)
-    im = im.transpose(Image.FLIP_TOP_BOTTOM)
-    im.save(fname_font, format="BMP")
+    profiler.start('font-unpack')
+    img = Image.frombytes('P', (WIDTH, HEIGHT), bytes(unpack_4bpp(data[PALETTE_SIZE:])))
+    img.putpalette(palette)
+    profiler.stop('font-unpack', items = NUM_GLYPHS)
+
+    profiler.start('font-save')
+    if os.path.splitext(fname_font)[1].lower() == '.png':
+        img.save(fname_font, format="PNG")
+    else:
+        img.save(fname_font, format="BMP")
+    profiler.stop('font-save', items = 1)
+
+    print("Done")
+
+
+def rebuild(fname_font, fname_elf_in, fname_elf_out, variable_width = False, in_place = False, progress = None):
+    ## When patching in place, the glyph cache from the previous run lets
+    ## only the glyphs that changed be written again
+    fname_cache = fname_elf_out + GLYPH_CACHE_SUFFIX
+    elf_file_out = OutputFile(fname_elf_in, fname_elf_out, in_place, restore = False)
+    cache = load_glyph_cache(fname_cache, fname_elf_in, fname_elf_out) if elf_file_out.patched else None
+
+    if cache is None or cache.get('variable_width') != bool(variable_width):
+        elf_file_out.restore()
+        cache = {}
+    else:
+        print(f"Updating existing output: {fname_elf_out}")
+
+    rv = pack_font(fname_font, elf_file_out, variable_width, cache, progress)
+    elf_file_out.close()
+    if rv:
+        return rv
+
+    cache['variable_width'] = bool(variable_width)
+    save_glyph_cache(fname_cache, cache, fname_elf_in, fname_elf_out)
+
+    if variable_width:
+        rv = apply_variable_width_code(fname_elf_out)
+        if rv:
+            return rv
+
+        ## armips changed code that was never written through elf_file_out.
+        ## Record it so the next in-place run can restore it.
+        elf_file_out.record_changes()
+        elf_file_out.save_state()
+        save_glyph_cache(fname_cache, cache, fname_elf_in, fname_elf_out)
 
     print("Done")
 
 
-def rebuild(fname_font, fname_elf_in, fname_elf_out, variable_width = False):
-    elf_file_out = open(fname_elf_out, 'wb')
+def load_glyph_cache(fname_cache, fname_elf_in, fname_elf_out):
+    """
+    Get the palette, colors and glyph hashes recorded by the previous rebuild.
+    Returns None if either ELF file changed since it was written.
+    """
+    if not os.path.exists(fname_cache):
+        return None
+
+    try:
+        with open(fname_cache, 'r') as f:
+            cache = json.loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+    ## script-rebuild writes to the same ELF, which keeps the patch state
+    ## valid but not the glyphs
+    if cache.get('input') != file_fingerprint(fname_elf_in):
+        return None
+    if cache.get('output') != file_fingerprint(fname_elf_out):
+        return None
+
+    return cache
 
-    ## Copy the input
-    with open(fname_elf_in, 'rb') as elf_file_in:
-        elf_file_out.write(elf_file_in.read())
 
+def save_glyph_cache(fname_cache, cache, fname_elf_in, fname_elf_out):
+    cache['input'] = file_fingerprint(fname_elf_in)
+    cache['output'] = file_fingerprint(fname_elf_out)
+    with open(fname_cache, 'w') as f:
+        f.write(json.dumps(cache))
 
+
+def glyph_lines(pos):
+    """
+    Pixel index of the start of each line of the glyph at table position pos
+    """
+    x = (pos % GLYPHS_PER_ROW) * GLYPH_SIZE
+    y = (pos // GLYPHS_PER_ROW) * GLYPH_SIZE
+    return range(y*WIDTH + x, (y + GLYPH_SIZE)*WIDTH + x, WIDTH)
+
+
+def glyph_hashes(rgba):
+    """
+    Hash the RGBA pixels of every 24x24 glyph
+    """
+    view = memoryview(rgba)
+    hashes = []
+    for pos in range(NUM_GLYPHS):
+        h = hashlib.sha1()
+        for start in glyph_lines(pos):
+            h.update(view[start*4 : (start + GLYPH_SIZE)*4])
+        hashes.append(h.hexdigest())
+    return hashes
+
+
+def glyph_code(pos):
+    ## Glyphs are labelled by their table code, so pack.tbl doesn't have to be found
+    code = ((pos // 94 + tbl.TABLE_OFFSET) << 8) + pos % 94 + tbl.TABLE_OFFSET
+    return f'{code:04X}'
+
+
+def nearest_color(pixel, palette):
+    ## Index of the closest palette color, ignoring alpha
+    best = 0
+    best_distance = None
+    for i, color in enumerate(palette):
+        distance = ((color >> 16 & 0xFF) - pixel[0])**2 + ((color >> 8 & 0xFF) - pixel[1])**2 + ((color & 0xFF) - pixel[2])**2
+        if best_distance is None or distance < best_distance:
+            best = i
+            best_distance = distance
+    return best
+
+
+def pack_font(fname_font, elf_file_out, variable_width = False, cache = None, progress = None):
+    """
+    Write the font image, and the width table if given, into an ELF file-like object
+
+    cache is updated with the palette, the color of every source pixel color and
+    the hash of every glyph. If it already holds them from a previous run into the
+    same output, the palette is kept and only the glyphs that changed are written.
+    progress is called with a ProgressEvent for every changed glyph.
+    """
     ########
     ## Format font image
     ########
     print("Processing font image")
+    profiler.start('font-decode')
     img = Image.open(fname_font)
+    img.load()
     # img = img.transpose(Image.FLIP_TOP_BOTTOM)
-    ## Reduce to a 4 bit pallete. Adaptive prevents dithering
-    img = img.convert('P', palette=Image.ADAPTIVE, colors=16)
 
     width = img.width
     height = img.height
@@ -55,49 +187,76 @@ def rebuild(fname_font, fname_elf_in, fname_elf_out, variable_width = False):
         print(f'Source file needs to have the dimensions {WIDTH}x{HEIGHT}. Got {width}x{height}')
         return 2
 
-    ## Palette needs to be in a specific order for alpha transparency to work correctly
-    ## Get the palette as a list of (R,B,G) tuples
-    palette = img.getpalette()
-    palette_tuples = [(palette[i], palette[i + 1], palette[i + 2]) for i in range(0, len(palette), 3)]
-
-    palette = []
-    palette_map = {}
-    for i in range (0, 16):
-        tup = palette_tuples[i]
-        color = tup[0]<<16 | tup[1]<<8 | tup[2]
-        if color != 0x79B441:
-            color = color + 0x80000000
-
-        palette.append(color)
-    ordered = palette.copy()
-    ordered.sort()
-
-    for i in range (0, 16):
-        palette_map[ordered[i]] = i
-
-    indexed = []
-
-    for i in range (0, 16):
-        indexed.append(palette_map[palette[i]])
-
-    #####
-    ## Write the pallete to file
-    #####
-    print("Writing font image")
-    elf_file_out.seek(OFFSET)
-
-    for i in range (0, 16):
-        elf_file_out.write(struct.pack('<I', ordered[i]))
-
-    #####
-    ## Write pixel data
-    #####
-    pixels = img.getdata()
-    for i in range(0, width*height, 2):
-        left = pixels[i]
-        right = pixels[i+1]
-        newpixel = (indexed[left] << 4) + indexed[right]
-        elf_file_out.write(struct.pack('B', newpixel))
+    if cache is not None:
+        rgba_img = img.convert('RGBA')
+        rgba = rgba_img.tobytes()
+        hashes = glyph_hashes(rgba)
+    profiler.stop('font-decode', items = 1)
+
+    if cache and len(cache.get('hashes', [])) == NUM_GLYPHS:
+        pack_changed_glyphs(rgba, hashes, elf_file_out, cache, progress)
+    else:
+        ## Palette needs to be in a specific order for alpha transparency to work correctly
+        ## Get the palette as a list of (R,B,G) tuples
+        profiler.start('font-index')
+        try:
+            palette_tuples, indices = index_font_image(img)
+        except ValueError as e:
+            profiler.stop('font-index')
+            print(e, file=sys.stderr)
+            return 2
+        profiler.stop('font-index', items = NUM_GLYPHS)
+
+        palette = []
+        palette_map = {}
+        for i in range (0, 16):
+            tup = palette_tuples[i]
+            color = tup[0]<<16 | tup[1]<<8 | tup[2]
+            if color != 0x79B441:
+                color = color + 0x80000000
+
+            palette.append(color)
+        ordered = palette.copy()
+        ordered.sort()
+
+        for i in range (0, 16):
+            palette_map[ordered[i]] = i
+
+        indexed = []
+
+        for i in range (0, 16):
+            indexed.append(palette_map[palette[i]])
+
+        #####
+        ## Write the pallete to file
+        #####
+        print("Writing font image")
+        profiler.start('font-write')
+        elf_file_out.seek(OFFSET)
+        elf_file_out.write(struct.pack('<16I', *ordered))
+
+        #####
+        ## Write pixel data
+        #####
+        elf_file_out.write(pack_4bpp(indices, indexed))
+        profiler.stop('font-write', items = NUM_GLYPHS, bytes_written = PALETTE_SIZE + len(indices)*BITDEPTH//8)
+
+        if cache is not None:
+            ## Remember which palette entry each source color ended up as, in
+            ## one pass that stops once every color has been seen
+            num_colors = len(rgba_img.getcolors(WIDTH*HEIGHT))
+            colors = {}
+            for color, index in zip(rgba_img.getdata(), indices):
+                if color not in colors:
+                    colors[color] = indexed[index]
+                    if len(colors) == num_colors:
+                        break
+            colors = {bytes(color).hex(): index for color, index in colors.items()}
+
+            cache.clear()
+            cache['palette'] = ordered
+            cache['colors'] = colors
+            cache['hashes'] = hashes
 
     if variable_width:
         print("Processing variable font widths")
@@ -113,23 +272,134 @@ def rebuild(fname_font, fname_elf_in, fname_elf_out, variable_width = False):
                 widths_data[index] = widths_table[char]
 
         elf_file_out.seek(WIDTH_TABLE)
+        elf_file_out.write(bytes(widths_data))
 
-        for i in range(0, TABLE_SIZE):
-            elf_file_out.write(struct.pack('B', widths_data[i]))
 
-        elf_file_out.close()
+def index_font_image(img):
+    """
+    Get the 16 colors of the font image as (R,G,B) tuples, and one palette
+    index per pixel. Images with up to 16 colors are used as they are,
+    whatever their mode. Anything else is quantized.
+    """
+    start = time.perf_counter()
+    used = img.getcolors(16) if img.mode == 'P' else None
+    exact = map_exact_colors(img) if img.mode != 'P' else None
 
-        if not check_bin('armips'):
-            print('Font successfully packed, but variable font widths are not installed because armips is not in your path.')
-            return 2
+    if used is not None:
+        palette = img.getpalette()
+        palette_tuples = [tuple(palette[i : i + 3]) for i in range(0, len(palette), 3)]
+        palette_tuples += [(0, 0, 0)] * (16 - len(palette_tuples))
+        indices = img.tobytes()
 
-        try:
-            out_dir = os.path.dirname(fname_elf_out)
-            shutil.copy('vfw.asm', out_dir)
-            # vfwpath = os.path.join(basedir, 'vfw.asm')
-            subprocess.check_call(['armips', 'vfw.asm', '-root', out_dir])
-        except subprocess.CalledProcessError:
-            print('armips failed to replace variable font width code.')
-            return 2
+        if max(index for _, index in used) >= 16:
+            ## Renumber the used palette entries 0-15. Unused entries are black
+            renumber = bytearray(256)
+            palette_tuples = [(0, 0, 0)] * 16
+            for i, (_, index) in enumerate(sorted(used, key=lambda x: x[1])):
+                palette_tuples[i] = tuple(palette[3*index : 3*index + 3])
+                renumber[index] = i
+            indices = indices.translate(renumber)
+        else:
+            ## Keep the whole palette, including entries no pixel uses
+            palette_tuples = palette_tuples[:16]
+        print(f"Using the image palette ({len(used)} colors): {time.perf_counter() - start:.2f}s")
+    elif exact is not None:
+        palette_tuples, indices = exact
+        print(f"Using the image colors: {time.perf_counter() - start:.2f}s")
+    else:
+        ## Reduce to a 4 bit pallete. Adaptive prevents dithering. Converting
+        ## P to P only copies the image, so other modes go through RGB first
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGB')
+        img = img.convert('P', palette=Image.ADAPTIVE, colors=16)
+        palette = img.getpalette()
+        palette_tuples = [(palette[i], palette[i + 1], palette[i + 2]) for i in range(0, len(palette), 3)]
+        palette_tuples += [(0, 0, 0)] * (16 - len(palette_tuples))
+        indices = img.tobytes()
+        if max(indices) >= 16:
+            raise ValueError("Could not reduce the font image to 16 colors")
+        print(f"Quantized to 16 colors: {time.perf_counter() - start:.2f}s")
 
-    print("Done")
+    return palette_tuples, indices
+
+
+def map_exact_colors(img):
+    """
+    Palette and indices of a non-indexed image with at most 16 RGB colors,
+    or None if it has more
+    """
+    rgb = img.convert('RGB')
+    used = rgb.getcolors(16)
+    if used is None:
+        return None
+
+    palette_tuples = [color for _, color in sorted(used, key=lambda x: x[1])]
+    ## Unused entries repeat the first color, so ties can be mapped back to it
+    palette_img = Image.new('P', (1, 1))
+    palette_img.putpalette([c for color in palette_tuples + [palette_tuples[0]] * (256 - len(palette_tuples)) for c in color])
+    indexed = rgb.quantize(palette=palette_img, dither=Image.Dither.NONE)
+
+    if indexed.convert('RGB').tobytes() == rgb.tobytes():
+        indices = indexed.tobytes().translate(bytes(i if i < len(palette_tuples) else 0 for i in range(256)))
+    else:
+        ## Close colors can share an entry in Pillow's lookup cache, so map them one pixel at a time
+        lookup = {color: i for i, color in enumerate(palette_tuples)}
+        indices = bytes(lookup[color] for color in rgb.getdata())
+    palette_tuples += [(0, 0, 0)] * (16 - len(palette_tuples))
+    return palette_tuples, indices
+
+
+def pack_changed_glyphs(rgba, hashes, elf_file_out, cache, progress = None):
+    """
+    Write the glyphs whose hash differs from the cache, using the cached palette
+    """
+    palette = cache['palette']
+    colors = {bytes.fromhex(key): index for key, index in cache['colors'].items()}
+    changed = [pos for pos in range(NUM_GLYPHS) if hashes[pos] != cache['hashes'][pos]]
+
+    print("Writing changed glyphs")
+    profiler.start('font-write')
+    written = Progress('Writing glyphs', len(changed), progress)
+    for pos in changed:
+        lines = glyph_lines(pos)
+        indices = bytearray(GLYPH_SIZE*GLYPH_SIZE)
+        i = 0
+        for start in lines:
+            for px in range(start*4, (start + GLYPH_SIZE)*4, 4):
+                pixel = rgba[px:px+4]
+                index = colors.get(pixel)
+                if index is None:
+                    index = colors[pixel] = nearest_color(pixel, palette)
+                indices[i] = index
+                i += 1
+
+        data = pack_4bpp(indices)
+        line_size = GLYPH_SIZE*BITDEPTH//8
+        for line, start in enumerate(lines):
+            elf_file_out.seek(OFFSET + PALETTE_SIZE + start*BITDEPTH//8)
+            elf_file_out.write(data[line*line_size : (line + 1)*line_size])
+        written.advance(glyph_code(pos))
+
+    profiler.stop('font-write', items = len(changed), bytes_written = len(changed)*GLYPH_SIZE*GLYPH_SIZE*BITDEPTH//8)
+
+    cache['colors'] = {key.hex(): index for key, index in colors.items()}
+    cache['hashes'] = hashes
+    print(f"Skipped {NUM_GLYPHS - len(changed)} unchanged glyphs")
+
+
+def apply_variable_width_code(fname_elf_out):
+    """
+    Assemble the variable font width code into the output ELF with armips
+    """
+    if not check_bin('armips'):
+        print('Font successfully packed, but variable font widths are not installed because armips is not in your path.')
+        return 2
+
+    try:
+        out_dir = os.path.dirname(fname_elf_out)
+        shutil.copy('vfw.asm', out_dir)
+        # vfwpath = os.path.join(basedir, 'vfw.asm')
+        subprocess.check_call(['armips', 'vfw.asm', '-root', out_dir])
+    except subprocess.CalledProcessError:
+        print('armips failed to replace variable font width code.')
+        return 2
@@ -4,46 +4,93 @@ import struct
 import json
 from PIL import Image
 from glob import glob
-from endotool.utils import read_in_chunks
+from typing import List
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from endotool import profiler
+from endotool.progress import Progress
 from endotool.bmp import write_file
+from endotool.exo import ExoArchive, SECTOR_SIZE
+from endotool.utils import file_hash, file_fingerprint
+from endotool.output import OutputFile
 from endotool.png import convert_indexed_colors_to_png, convert_bitmap_to_png, convert_png_to_8bit_indexed, convert_png_to_bitmap
 from endotool.file_structures.images import *
 
 TEXTURE_END = 0x04a89800
 PALETTE_SIZE = 0x400
-DATA_8BIT = 0x08
-DATA_32BIT = 0x18
 
-UNKNOWN_SIZES = {0x5A9000: {'width': 256, 'height': 256, 'bitdepth': 24}}
-
-
-def unpack(fname_exo : str, dir_output : str):
-    if len(fname_exo) <= 0:
-        print('Please enter a valid EXO.BIN file path.', file = sys.stderr)
-        return 2
-    try:
-        exo = open(fname_exo, 'rb')
-    except IOError as e:
-        print(e, file = sys.stderr)
-        return 2
+MANIFEST_SUFFIX = '.manifest.json'
+TOC_SUFFIX = '.toc.json'
 
-    os.makedirs(dir_output, exist_ok=True)
-    if not os.path.isdir(dir_output):
-        print('Output is not a folder.')
-        return 2
+UNKNOWN_SIZES = {0x5A9000: {'width': 256, 'height': 256, 'bitdepth': 24}}
 
-    print(f'Output directory: {dir_output}')
+## Regions between textures that have to be jumped over
+SKIPPED_REGIONS = {0x01A60800: 0x01A61000, 0x0364A000: 0x0364A800}
+
+
+class TextureDescriptor:
+    """
+    Location and format of a single texture inside EXO.BIN
+    """
+    def __init__(self, pos: int, offset_to_start_of_data: int, width: int, height: int, bitdepth: int,
+                 header_size: int = 0, num_frames: int = 0, num_animations: int = 0) -> None:
+        self.pos = pos
+        self.offset_to_start_of_data = offset_to_start_of_data
+        self.width = width
+        self.height = height
+        self.bitdepth = bitdepth
+        self.header_size = header_size
+        self.num_frames = num_frames
+        self.num_animations = num_animations
+        ## Parsed header, if it was already read while scanning
+        self.info: PackedImageInfo = None
+
+    def serialize(self):
+        return {
+            'pos': self.pos,
+            'offset_to_start_of_data': self.offset_to_start_of_data,
+            'width': self.width,
+            'height': self.height,
+            'bitdepth': self.bitdepth,
+            'header_size': self.header_size,
+            'num_frames': self.num_frames,
+            'num_animations': self.num_animations,
+        }
+
+    @property
+    def sector(self) -> int:
+        return self.pos // SECTOR_SIZE
+
+    @property
+    def data_offset(self) -> int:
+        return self.pos + self.offset_to_start_of_data
+
+    @property
+    def data_size(self) -> int:
+        if self.bitdepth == 8:
+            return PALETTE_SIZE + self.width * self.height
+        return self.width * self.height * 4
+
+    @property
+    def fname_base(self) -> str:
+        return f'{self.pos/2048:05.0f}-{self.data_offset:08X}-{self.bitdepth:02d}'
+
+
+def scan_textures(exo: ExoArchive) -> List[TextureDescriptor]:
+    """
+    Walk EXO.BIN and collect the location of every texture without decoding it
+    """
+    textures: List[TextureDescriptor] = []
 
     pos = 0
     while pos < TEXTURE_END:
-        exo.seek(pos)
-
-        sectionsize = struct.unpack('<I', exo.read(4))[0]
+        sectionsize = exo.u32(pos)
         if sectionsize == 0:
             raise Exception("Invalid value")
 
-        offset_to_start_of_data = struct.unpack('<I', exo.read(4))[0]
-        exo.seek(pos + offset_to_start_of_data)
+        ## Everything needed is in the header, so parse it once and keep it for extraction
+        info = PackedImageInfo()
+        info.from_buffer(exo.view, pos)
 
         # Some of these values are just not provided
         if pos in UNKNOWN_SIZES:
@@ -51,111 +98,403 @@ def unpack(fname_exo : str, dir_output : str):
             height = UNKNOWN_SIZES[pos]['height']
             bitdepth = UNKNOWN_SIZES[pos]['bitdepth']
         else:
-            bitdepth = 0
-            while bitdepth != DATA_8BIT and bitdepth != DATA_32BIT:
-                exo.seek(-1, 1)
-                bitdepth = struct.unpack('<B', exo.read(1))[0]
-                exo.seek(-1, 1)
-            exo.seek(-8, 1)
-            width = struct.unpack('<I', exo.read(4))[0]
-            height = struct.unpack('<I', exo.read(4))[0]
+            width = info.image_width
+            height = info.image_height
+            bitdepth = info.bitdepth
+
+        if bitdepth != 8 and bitdepth != 24:
+            raise Exception(f"Unsupported bitdepth: {bitdepth}")
 
-        fname_base = f'{pos/2048:05.0f}-{pos + offset_to_start_of_data:08X}-{bitdepth:02d}'
-        png_fname = os.path.join(dir_output, fname_base + '.png')
-        json_fname = os.path.join(dir_output, fname_base + '.json')
-        print(f"{fname_base}.png")
+        texture = TextureDescriptor(pos, info.img_data_offset_qqq, width, height, bitdepth,
+                                    info.header_size, len(info.frame_image_data), len(info.animations))
+        texture.info = info
+        textures.append(texture)
 
-        ## IMAGE PIXEL DATA
+        # Align position to the next nearest block
+        data_end = min(texture.data_offset + texture.data_size, len(exo))
+        if (data_end % SECTOR_SIZE) == 0:
+            next_pos = data_end
+        else:
+            next_pos = (int(data_end / SECTOR_SIZE)+1)*SECTOR_SIZE
 
-        exo.seek(pos + offset_to_start_of_data)
+        pos = SKIPPED_REGIONS.get(next_pos, next_pos)
 
-        # 8-bit indexed images are in BGRA format
-        if bitdepth == 8:
-            palette = exo.read(PALETTE_SIZE)
-            indices = exo.read(width * height)
-            convert_indexed_colors_to_png(width, height, list(palette), list(indices), png_fname)
+    return textures
 
-        elif bitdepth == 24:
-            data = []
-            for piece in read_in_chunks(exo, size = width * height * 4):
-                data.append(struct.unpack('BBBB', piece))
 
-            convert_bitmap_to_png(width, height, data, png_fname)
+def load_toc(fname_toc: str, fname_exo: str):
+    """
+    Get the textures from a saved table of contents, if it matches EXO.BIN
+    """
+    if not os.path.exists(fname_toc):
+        return None
 
-        else:
-            raise Exception(f"Unsupported bitdepth: {bitdepth}")
+    try:
+        with open(fname_toc, 'r') as f:
+            toc = json.loads(f.read())
+    except (IOError, ValueError):
+        return None
 
-        # print(f"Extracted PNG")
+    if toc.get('exo') != file_fingerprint(fname_exo) or toc.get('end') != TEXTURE_END:
+        return None
+
+    return [TextureDescriptor(**record) for record in toc['textures']]
 
-        # Align position to the next nearest block
-        if (exo.tell() % 2048) == 0:
-            next_pos = exo.tell()
-        else:
-            next_pos = (int(exo.tell() / 2048)+1)*2048
 
-        if next_pos == 0x01A60800:
-            next_pos = 0x01A61000
-        if next_pos == 0x0364A000:
-            next_pos = 0x0364A800
+def texture_index(fname_exo: str, exo: ExoArchive) -> List[TextureDescriptor]:
+    """
+    List the textures in EXO.BIN. The scan result is saved next to EXO.BIN and
+    reused until the file changes.
+    """
+    fname_toc = fname_exo + TOC_SUFFIX
+    textures = load_toc(fname_toc, fname_exo)
+    if textures is not None:
+        return textures
 
-        ## IMAGE METADATA
-        exo.seek(pos)
+    textures = scan_textures(exo)
+    try:
+        with open(fname_toc, 'w') as f:
+            f.write(json.dumps({
+                'exo': file_fingerprint(fname_exo),
+                'end': TEXTURE_END,
+                'textures': [texture.serialize() for texture in textures],
+            }))
+    except IOError:
+        ## EXO.BIN may be somewhere read-only. The scan is just repeated next time.
+        pass
+
+    return textures
+
+
+def parse_sector_range(sector_range: str):
+    """
+    Get the first and last sector from a range like 100-200. Either end may be left out.
+    """
+    first, sep, last = sector_range.partition('-')
+    if not sep:
+        last = first
+    first = int(first) if first else 0
+    last = int(last) if last else None
+    return first, last
+
+
+def select_textures(textures: List[TextureDescriptor], only: str = None, sector_range: str = None, bitdepth: int = None) -> List[TextureDescriptor]:
+    """
+    Filter the texture list. only is a comma-separated list of texture names
+    (like 00001-00000880-08) or sector numbers.
+    """
+    if only:
+        names = set()
+        sectors = set()
+        for name in only.split(','):
+            name = os.path.basename(name.strip()).split('.')[0]
+            if '-' in name:
+                names.add(name)
+            elif name:
+                sectors.add(int(name))
+        textures = [t for t in textures if t.fname_base in names or t.sector in sectors]
+
+    if sector_range:
+        first, last = parse_sector_range(sector_range)
+        textures = [t for t in textures if first <= t.sector and (last is None or t.sector <= last)]
+
+    if bitdepth:
+        textures = [t for t in textures if t.bitdepth == bitdepth]
+
+    return textures
+
+
+def extract_texture(exo: ExoArchive, texture: TextureDescriptor, dir_output: str) -> None:
+    png_fname = os.path.join(dir_output, texture.fname_base + '.png')
+    json_fname = os.path.join(dir_output, texture.fname_base + '.json')
+
+    ## IMAGE PIXEL DATA
+    width = texture.width
+    height = texture.height
+    data_pos = texture.data_offset
+
+    # 8-bit indexed images are in BGRA format
+    profiler.start('image-png-encode')
+    if texture.bitdepth == 8:
+        palette = exo.block(data_pos, PALETTE_SIZE)
+        indices = exo.block(data_pos + PALETTE_SIZE, width * height)
+        convert_indexed_colors_to_png(width, height, palette, indices, png_fname)
+    else:
+        data = exo.block(data_pos, width * height * 4)
+        convert_bitmap_to_png(width, height, data, png_fname)
+    profiler.stop('image-png-encode', items = 1, bytes_read = texture.data_size)
+
+    ## IMAGE METADATA
+    profiler.start('image-metadata')
+    info = texture.info
+    if info is None:
         info = PackedImageInfo()
-        info.from_buffer(exo)
-        ser = info.serialize()
+        info.from_buffer(exo.view, texture.pos)
+    ser = info.serialize()
+
+    with open(json_fname, 'w') as file:
+        # yaml.dump(ser, file, sort_keys=False)
+        file.write(json.dumps(ser, indent=4))
+    profiler.stop('image-metadata', items = 1)
 
-        with open(json_fname, 'w') as file:
-            # yaml.dump(ser, file, sort_keys=False)
-            file.write(json.dumps(ser, indent=4))
 
-        ## FINALIZE LOOP
-        pos = next_pos
+## Each worker process maps EXO.BIN once and reuses it for every texture
+_worker_exo: ExoArchive = None
+
+def _init_extract_worker(fname_exo: str) -> None:
+    global _worker_exo
+    _worker_exo = ExoArchive(fname_exo)
+
+def _extract_worker(texture: TextureDescriptor, dir_output: str) -> str:
+    extract_texture(_worker_exo, texture, dir_output)
+    return texture.fname_base
+
+
+def open_exo(fname_exo : str):
+    if len(fname_exo) <= 0:
+        print('Please enter a valid EXO.BIN file path.', file = sys.stderr)
+        return None
+    try:
+        return ExoArchive(fname_exo)
+    except (IOError, ValueError) as e:
+        print(e, file = sys.stderr)
+        return None
+
 
+def list_textures(fname_exo : str, only : str = None, sector_range : str = None, bitdepth : int = None):
+    exo = open_exo(fname_exo)
+    if exo is None:
+        return 2
+
+    try:
+        textures = select_textures(texture_index(fname_exo, exo), only, sector_range, bitdepth)
+    except ValueError as e:
+        exo.close()
+        print(e, file = sys.stderr)
+        return 2
+    exo.close()
+
+    print(f"{'Name':<20} {'Size':>9} {'Header':>6} {'Frames':>6} {'Anims':>5}")
+    for texture in textures:
+        size = f'{texture.width}x{texture.height}'
+        print(f"{texture.fname_base:<20} {size:>9} {texture.header_size:>6} {texture.num_frames:>6} {texture.num_animations:>5}")
+    print(f"{len(textures)} textures")
+
+
+def unpack(fname_exo : str, dir_output : str, jobs : int = 1, only : str = None, sector_range : str = None, bitdepth : int = None, progress = None):
+    exo = open_exo(fname_exo)
+    if exo is None:
+        return 2
+
+    os.makedirs(dir_output, exist_ok=True)
+    if not os.path.isdir(dir_output):
+        print('Output is not a folder.')
+        return 2
+
+    print(f'Output directory: {dir_output}')
+
+    ## Find all the textures first. They're independent after that.
+    profiler.start('image-scan')
+    try:
+        textures = select_textures(texture_index(fname_exo, exo), only, sector_range, bitdepth)
+    except ValueError as e:
+        exo.close()
+        print(e, file = sys.stderr)
+        return 2
+    profiler.stop('image-scan', items = len(textures))
+
+    ## Per-texture stages from worker processes are merged back as their results arrive
+    profiler.start('image-extract')
+    extracted = Progress('Extracting images', len(textures), progress)
+    if jobs <= 1 or len(textures) <= 1:
+        for texture in textures:
+            extract_texture(exo, texture, dir_output)
+            extracted.advance(f"{texture.fname_base}.png")
+    else:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_extract_worker, initargs=(fname_exo,)) as executor:
+            results = profiler.collect(executor.map(profiler.Profiled(_extract_worker), textures, repeat(dir_output), chunksize=8))
+            for fname_base in results:
+                extracted.advance(f"{fname_base}.png")
+    profiler.stop('image-extract', items = len(textures))
+
+    exo.close()
     print("Image extraction complete")
 
-def rebuild(dir_input : str, fname_exo_in: str, fname_exo_out: str):
-    exo = open(fname_exo_out, 'wb+')
-    with open(fname_exo_in, 'rb') as exo_file_in:
-        exo.write(exo_file_in.read())
+def parse_texture_fname(path: str):
+    """
+    Get the sector, data offset and bitdepth from a file name like 00001-00000880-08.png
+    """
+    block_idx, offset, bitdepth = os.path.basename(path).split('.')[0].split('-')
+    return int(block_idx), int(offset, 16), int(bitdepth)
+
+
+@profiler.timed('image-png-decode')
+def encode_texture(path_png: str):
+    """
+    Convert a PNG into the bytes to write at its data offset in EXO.BIN
+    """
+    block_idx, offset, bitdepth = parse_texture_fname(path_png)
+
+    if bitdepth == 8:
+        data = convert_png_to_8bit_indexed(path_png)
+    else:
+        data = convert_png_to_bitmap(path_png)
+
+    return offset, data
+
+
+def load_manifest(fname_manifest: str, fname_exo_in: str, fname_exo_out: str):
+    """
+    Get the list of files written by the previous rebuild. Returns None if
+    there isn't one, or if either EXO file changed since it was written.
+    """
+    if not os.path.exists(fname_manifest) or not os.path.exists(fname_exo_out):
+        return None
+
+    try:
+        with open(fname_manifest, 'r') as f:
+            manifest = json.loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+    ## Other commands can write to the same output, which keeps the patch
+    ## state valid but not the list of files
+    if manifest.get('input') != file_fingerprint(fname_exo_in):
+        return None
+    if manifest.get('output') != file_fingerprint(fname_exo_out):
+        return None
+
+    return manifest
+
+
+def pack_images(dir_input : str, exo, exo_in = None, jobs : int = 1, old_files : dict = None, progress = None):
+    """
+    Write the images and image info in dir_input into an EXO.BIN file-like object.
+
+    old_files is the file list from a previous run into the same output. Files
+    with the same hash are skipped, and exo_in is used to restore the original
+    data of files that were removed or moved.
+    Returns the new file list and the names of the skipped files.
+    progress is called with a ProgressEvent for every file written.
+    """
+    if old_files is None:
+        old_files = {}
+
+    new_files = {}
+    hashes = {}
+    unchanged = []
+
+    def write_region(fname, offset, data):
+        ## Put back the original bytes if this file previously covered a different region
+        old = old_files.get(fname)
+        if old is not None and (old['offset'] != offset or old['size'] != len(data)):
+            restore_region(old)
+
+        profiler.start('image-write')
+        exo.seek(offset)
+        exo.write(data)
+        profiler.stop('image-write', items = 1, bytes_written = len(data))
+        new_files[fname] = {'hash': hashes[fname], 'offset': offset, 'size': len(data)}
+
+    def restore_region(record):
+        exo_in.seek(record['offset'])
+        exo.seek(record['offset'])
+        exo.write(exo_in.read(record['size']))
+
+    def split_changed(paths):
+        profiler.start('image-hash')
+        changed = []
+        for path in paths:
+            fname = os.path.basename(path)
+            hashes[fname] = file_hash(path)
+            old = old_files.get(fname)
+            if old is not None and old['hash'] == hashes[fname]:
+                new_files[fname] = old
+                unchanged.append(fname)
+            else:
+                changed.append(path)
+        profiler.stop('image-hash', items = len(paths))
+        return changed
+
+    ## Sorted so the results come back, and get written, in offset order
+    paths_png = sorted(glob(os.path.join(dir_input, '*-*-*.png')), key=lambda x: parse_texture_fname(x)[1])
+    paths_json = glob(os.path.join(dir_input, '*-*-*.json'))
+
+    ## Files that were removed since the last run get their original data back
+    fnames = set(os.path.basename(path) for path in paths_png + paths_json)
+    for fname, record in old_files.items():
+        if fname not in fnames:
+            restore_region(record)
 
     ###############
     ## Save image
     ###############
     print(f"== PACKING IMAGES: {dir_input} ==")
 
-    for path_png in glob(os.path.join(dir_input, '*-*-*.png')):
-        print(f"{os.path.split(path_png)[1]}")
+    paths_png = split_changed(paths_png)
 
-        block_idx, offset, bitdepth = os.path.basename(path_png).split('.')[0].split('-')
-        offset = int(offset, 16)
-        bitdepth = int(bitdepth)
-
-        if bitdepth == 8:
-            data = convert_png_to_8bit_indexed(path_png)
-            exo.seek(offset)
-            exo.write(data)
-        else:
-            data = convert_png_to_bitmap(path_png)
-            exo.seek(offset)
-            exo.write(data)
+    packed = Progress('Packing images', len(paths_png), progress)
+    def write_images(results):
+        for path_png, (offset, data) in zip(paths_png, results):
+            write_region(os.path.basename(path_png), offset, data)
+            packed.advance(os.path.basename(path_png))
 
+    if jobs <= 1 or len(paths_png) <= 1:
+        write_images(map(encode_texture, paths_png))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            write_images(profiler.collect(executor.map(profiler.Profiled(encode_texture), paths_png, chunksize=4)))
 
     ###############
     ## Save image info
     ###############
     print(f"== PACKING IMAGE INFO: {dir_input} ==")
-    for path_json in glob(os.path.join(dir_input, '*-*-*.json')):
+    paths_json = split_changed(paths_json)
+    packed = Progress('Packing image info', len(paths_json), progress)
+    for path_json in paths_json:
         if os.path.exists(path_json):
-            print(f"{os.path.split(path_json)[1]}")
-
             with open(path_json, 'r') as f:
                 json_data = json.loads(f.read())
 
+            profiler.start('image-metadata')
             img_info = PackedImageInfo()
             img_info.deserialize(json_data)
             byte_data = img_info.rebuild()
-            exo.seek(img_info.offset_start)
-            exo.write(byte_data)
-
+            profiler.stop('image-metadata', items = 1)
+            write_region(os.path.basename(path_json), img_info.offset_start, byte_data)
+        packed.advance(os.path.basename(path_json))
+
+    return new_files, unchanged
+
+
+def rebuild(dir_input : str, fname_exo_in: str, fname_exo_out: str, jobs : int = 1, in_place : bool = False, progress = None):
+    ## The manifest records what was written by the previous run so only
+    ## changed files need to be encoded again. The output is reused as long
+    ## as neither EXO file changed since then and in_place is set.
+    fname_manifest = fname_exo_out + MANIFEST_SUFFIX
+    exo = OutputFile(fname_exo_in, fname_exo_out, in_place, restore = False)
+    manifest = load_manifest(fname_manifest, fname_exo_in, fname_exo_out) if exo.patched else None
+
+    if manifest is None:
+        ## Without the manifest nothing written by the previous run can be kept
+        exo.restore()
+        old_files = {}
+    else:
+        print(f"Updating existing output: {fname_exo_out}")
+        old_files = manifest['files']
+
+    exo_in = open(fname_exo_in, 'rb')
+    new_files, unchanged = pack_images(dir_input, exo, exo_in, jobs, old_files, progress)
+    exo_in.close()
     exo.close()
-    print(f"Rebuild images complete")
\ No newline at end of file
+
+    with open(fname_manifest, 'w') as f:
+        f.write(json.dumps({
+            'input': file_fingerprint(fname_exo_in),
+            'output': file_fingerprint(fname_exo_out),
+            'files': new_files,
+        }, indent=4))
+
+    if manifest is not None:
+        print(f"Skipped {len(unchanged)} unchanged files")
+    print(f"Rebuild images complete")
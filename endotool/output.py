@@ -0,0 +1,141 @@
+import os
+import json
+from typing import List, Tuple
+
+from endotool.utils import copy_file, file_fingerprint
+
+STATE_SUFFIX = '.patch.json'
+
+
+class OutputFile:
+    """
+    Output file that starts out as a copy of an input file.
+
+    Every region written is recorded in a state file next to the output,
+    along with the fingerprints of both files. With in_place=True, an output
+    that was made from the same (unchanged) input is patched directly instead
+    of copying the input again. The regions written by the previous run are
+    restored from the input first, unless restore=False, so the result is the
+    same as starting from a fresh copy.
+    """
+
+    def __init__(self, fname_in : str, fname_out : str, in_place : bool = False, restore : bool = True) -> None:
+        self.fname_in = fname_in
+        self.fname_out = fname_out
+        self.fname_state = fname_out + STATE_SUFFIX
+        self.regions : List[Tuple[int, int]] = []
+
+        state = self.load_state() if in_place else None
+        self.patched = state is not None
+
+        if state is None:
+            copy_file(fname_in, fname_out)
+            self.file = open(fname_out, 'r+b')
+            return
+
+        self.file = open(fname_out, 'r+b')
+        self.regions = [tuple(r) for r in state['regions']]
+        if restore:
+            self.restore()
+
+    def __enter__(self) -> 'OutputFile':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def load_state(self):
+        ## The state is only usable if neither file changed since it was saved
+        if not os.path.exists(self.fname_state) or not os.path.exists(self.fname_out):
+            return None
+
+        try:
+            with open(self.fname_state, 'r') as f:
+                state = json.loads(f.read())
+        except (IOError, ValueError):
+            return None
+
+        if state.get('input') != file_fingerprint(self.fname_in):
+            return None
+        if state.get('output') != file_fingerprint(self.fname_out):
+            return None
+
+        return state
+
+    def save_state(self) -> None:
+        with open(self.fname_state, 'w') as f:
+            f.write(json.dumps({
+                'input': file_fingerprint(self.fname_in),
+                'output': file_fingerprint(self.fname_out),
+                'regions': merge_regions(self.regions),
+            }))
+
+    def restore(self) -> None:
+        ## Put back the input data of every region written so far
+        with open(self.fname_in, 'rb') as file_in:
+            for offset, size in merge_regions(self.regions):
+                file_in.seek(offset)
+                self.file.seek(offset)
+                self.file.write(file_in.read(size))
+        self.regions = []
+
+        ## Anything past the end of the input was written by a previous run
+        size_in = os.path.getsize(self.fname_in)
+        if os.fstat(self.file.fileno()).st_size > size_in:
+            self.file.truncate(size_in)
+
+    def record_changes(self, block_size : int = 0x1000) -> None:
+        """
+        Record every block of the closed output that differs from the input as
+        written. Used after other programs changed the output, so restore()
+        reverts their changes too.
+        """
+        with open(self.fname_in, 'rb') as file_in, open(self.fname_out, 'rb') as file_out:
+            offset = 0
+            while True:
+                data_in = file_in.read(block_size)
+                data_out = file_out.read(block_size)
+                if not data_in and not data_out:
+                    break
+                if data_in != data_out:
+                    self.regions.append((offset, max(len(data_in), len(data_out))))
+                offset += block_size
+
+    def seek(self, offset : int, whence : int = os.SEEK_SET) -> int:
+        return self.file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def read(self, size : int = -1) -> bytes:
+        return self.file.read(size)
+
+    def truncate(self, size : int) -> int:
+        return self.file.truncate(size)
+
+    def write(self, data) -> int:
+        offset = self.file.tell()
+        ## Sequential writes extend the previous region
+        if self.regions and sum(self.regions[-1]) == offset:
+            self.regions[-1] = (self.regions[-1][0], self.regions[-1][1] + len(data))
+        else:
+            self.regions.append((offset, len(data)))
+        return self.file.write(data)
+
+    def close(self) -> None:
+        if self.file.closed:
+            return
+        self.file.close()
+        self.save_state()
+
+
+def merge_regions(regions):
+    ## Combine overlapping and touching (offset, size) regions
+    merged = []
+    for offset, size in sorted(regions):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            last_offset, last_size = merged[-1]
+            merged[-1] = [last_offset, max(last_size, offset + size - last_offset)]
+        elif size > 0:
+            merged.append([offset, size])
+    return merged
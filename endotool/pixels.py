@@ -0,0 +1,148 @@
+"""
+Whole-buffer pixel conversions between the PS2 GS formats used in EXO.BIN and
+regular RGBA data.
+
+The PS2 stores alpha as 0x00-0x80 (0x80 being opaque) and 8-bit palettes
+use the CSM1 block arrangement. Everything here works on bytes-like objects
+with slicing, bytes.translate lookup tables and big-int bitwise operations
+instead of per-pixel Python loops.
+"""
+
+## PS2 alpha (0x00-0x80) to full byte alpha (0x00-0xFF)
+ALPHA_EXPAND = bytes(0xFF if x == 0x80 else min(x*2, 0xFF) for x in range(256))
+
+## Full byte alpha (0x00-0xFF) to PS2 alpha (0x00-0x80)
+ALPHA_COMPRESS = bytes(0x80 if x == 0xFF else x >> 1 for x in range(256))
+
+## Masks used to build a one-byte-per-pixel selection (0x01 = selected)
+_IS_FF = bytes(1 if x == 0xFF else 0 for x in range(256))
+_IS_00 = bytes(1 if x == 0x00 else 0 for x in range(256))
+
+CLUT_BLOCK = 8*4
+
+
+def swizzle_clut(palette) -> bytearray:
+    """
+    Swap the 2nd and 3rd 8-colour blocks of every 32-colour group.
+    The operation is its own inverse, so it is used in both directions.
+    """
+    palette = bytearray(palette)
+    for idx in range(0, 256*4, 32*4):
+        block1_idx = idx+CLUT_BLOCK
+        block2_idx = idx+2*CLUT_BLOCK
+
+        temp = palette[block1_idx:block1_idx+CLUT_BLOCK]
+        palette[block1_idx:block1_idx+CLUT_BLOCK] = palette[block2_idx:block2_idx+CLUT_BLOCK]
+        palette[block2_idx:block2_idx+CLUT_BLOCK] = temp
+
+    return palette
+
+
+def expand_alpha(data) -> bytearray:
+    """
+    Convert the alpha channel of interleaved RGBA data from PS2 to full byte alpha.
+    """
+    data = bytearray(data)
+    data[3::4] = data[3::4].translate(ALPHA_EXPAND)
+    return data
+
+
+def compress_alpha(data) -> bytearray:
+    """
+    Convert the alpha channel of interleaved RGBA data from full byte to PS2 alpha.
+    """
+    data = bytearray(data)
+    data[3::4] = data[3::4].translate(ALPHA_COMPRESS)
+    return data
+
+
+def zero_transparent_white(data) -> bytearray:
+    """
+    Set the RGB components of fully transparent white pixels (FF FF FF 00) to zero.
+    """
+    data = bytearray(data)
+    alpha = data[3::4]
+    num_pixels = len(alpha)
+    if num_pixels == 0:
+        return data
+
+    ## One byte per pixel, 0x01 where the pixel is transparent white
+    mask = int.from_bytes(alpha.translate(_IS_00), 'little')
+    for channel in range(3):
+        mask &= int.from_bytes(data[channel::4][:num_pixels].translate(_IS_FF), 'little')
+
+    if mask == 0:
+        return data
+
+    ## Spread 0x01 to 0xFF. There are no carries since every byte is 0 or 1
+    mask *= 0xFF
+    for channel in range(3):
+        plane = data[channel::4]
+        size = len(plane)
+        keep = ((1 << (8*size)) - 1) ^ mask
+        data[channel::4] = (int.from_bytes(plane, 'little') & keep).to_bytes(size, 'little')
+
+    return data
+
+
+def ps2_to_rgba_palette(palette) -> bytearray:
+    """
+    Convert a swizzled PS2 palette into a linear RGBA palette.
+    """
+    return expand_alpha(swizzle_clut(palette))
+
+
+def rgba_to_ps2_palette(palette) -> bytearray:
+    """
+    Convert a linear RGBA palette into a swizzled PS2 palette.
+    """
+    return compress_alpha(swizzle_clut(palette))
+
+
+def ps2_to_rgba(data) -> bytearray:
+    """
+    Convert 32-bit PS2 pixel data into RGBA.
+    """
+    return expand_alpha(data)
+
+
+def rgba_to_ps2(data) -> bytearray:
+    """
+    Convert RGBA pixel data into 32-bit PS2 pixel data.
+    RGB components of transparent white pixels are set to zero.
+    """
+    return compress_alpha(zero_transparent_white(data))
+
+
+def pack_4bpp(indices, remap=range(16)) -> bytes:
+    """
+    Pack one-byte-per-pixel palette indices into 4bpp data, first pixel in the
+    high nibble. Indices are passed through the 16-entry remap table first.
+    Raises ValueError if any index doesn't fit in 4 bits.
+    """
+    if len(indices) and max(indices) >= 16:
+        raise ValueError(f"Palette index {max(indices)} doesn't fit in 4 bits")
+
+    ## Only the first 16 entries can be reached
+    high = bytes(remap[x] << 4 for x in range(16)) + bytes(240)
+    low = bytes(remap[x] for x in range(16)) + bytes(240)
+
+    size = len(indices) // 2
+    high_nibbles = int.from_bytes(bytes(indices[0::2][:size]).translate(high), 'little')
+    low_nibbles = int.from_bytes(bytes(indices[1::2][:size]).translate(low), 'little')
+    return (high_nibbles | low_nibbles).to_bytes(size, 'little')
+
+
+_HIGH_NIBBLE = bytes(x >> 4 for x in range(256))
+_LOW_NIBBLE = bytes(x & 0xF for x in range(256))
+
+
+def unpack_4bpp(data) -> bytearray:
+    """
+    Unpack 4bpp data into one byte per pixel, first pixel in the high nibble.
+    """
+    data = bytes(data)
+    indices = bytearray(len(data) * 2)
+    indices[0::2] = data.translate(_HIGH_NIBBLE)
+    indices[1::2] = data.translate(_LOW_NIBBLE)
+    return indices
@@ -0,0 +1,245 @@
+import os
+import sys
+import time
+import json
+import functools
+import contextlib
+import tracemalloc
+from typing import Dict, List
+
+try:
+    import resource
+except ImportError:
+    ## Not available on Windows
+    resource = None
+
+## Nothing is recorded unless enabled. Timers cost one flag check otherwise.
+enabled = False
+trace_memory = False
+
+
+class Timer:
+    """
+    Total time, calls and counters of one named stage
+    """
+    def __init__(self, name : str) -> None:
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.items = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_memory = 0
+
+    def serialize(self):
+        rv = {
+            'calls': self.calls,
+            'seconds': round(self.seconds, 4),
+            'items': self.items,
+            'items_per_sec': round(self.items / self.seconds, 1) if self.seconds > 0 else 0,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+        }
+        if trace_memory:
+            rv['peak_memory'] = self.peak_memory
+        return rv
+
+
+timers : Dict[str, Timer] = {}
+_open : List[Timer] = []
+_started : Dict[str, float] = {}
+_start = 0.0
+_peak = 0
+## Process that enabled profiling. Forked workers start with a copy of its timers.
+_pid = None
+
+
+def enable(memory : bool = False) -> None:
+    global enabled, trace_memory, _start, _peak, _pid
+    enabled = True
+    trace_memory = memory
+    timers.clear()
+    _open.clear()
+    _started.clear()
+    _pid = os.getpid()
+    _start = time.perf_counter()
+    _peak = 0
+    if trace_memory:
+        tracemalloc.start()
+
+
+def get_timer(name : str) -> Timer:
+    if name not in timers:
+        timers[name] = Timer(name)
+    return timers[name]
+
+
+def count(name : str, items : int = 0, bytes_read : int = 0, bytes_written : int = 0) -> None:
+    if not enabled:
+        return
+    t = get_timer(name)
+    t.items += items
+    t.bytes_read += bytes_read
+    t.bytes_written += bytes_written
+
+
+def _update_peak() -> None:
+    ## Every open timer gets the peak since the last check, so nested timers
+    ## don't hide each other's peaks
+    global _peak
+    peak = tracemalloc.get_traced_memory()[1]
+    _peak = max(_peak, peak)
+    for t in _open:
+        t.peak_memory = max(t.peak_memory, peak)
+    tracemalloc.reset_peak()
+
+
+def start(name : str) -> None:
+    """
+    Start timing a stage. Stages can be nested and overlap, so their times
+    don't add up to the total.
+    """
+    if not enabled:
+        return
+    t = get_timer(name)
+    if trace_memory:
+        _update_peak()
+    _open.append(t)
+    _started[name] = time.perf_counter()
+
+
+def stop(name : str, items : int = 0, bytes_read : int = 0, bytes_written : int = 0) -> None:
+    if not enabled or name not in _started:
+        return
+    t = timers[name]
+    t.seconds += time.perf_counter() - _started.pop(name)
+    t.calls += 1
+    t.items += items
+    t.bytes_read += bytes_read
+    t.bytes_written += bytes_written
+    if trace_memory:
+        _update_peak()
+    _open.remove(t)
+
+
+@contextlib.contextmanager
+def timer(name : str, items : int = 0, bytes_read : int = 0, bytes_written : int = 0):
+    """
+    Time the code in a with block
+    """
+    start(name)
+    try:
+        yield
+    finally:
+        stop(name, items, bytes_read, bytes_written)
+
+
+def timed(name : str):
+    """
+    Decorator that times every call of a function. Each call counts as one item.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with timer(name, items = 1):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Profiled:
+    """
+    Picklable wrapper for a function run in a worker process. Returns the
+    result along with the counters the call recorded, which collect() adds to
+    the parent's timers. Workers don't trace memory.
+    """
+    def __init__(self, func) -> None:
+        self.func = func
+        self.enabled = enabled
+
+    def __call__(self, *args, **kwargs):
+        if not self.enabled:
+            return self.func(*args, **kwargs), None
+        if _pid != os.getpid():
+            enable()
+        rv = self.func(*args, **kwargs)
+        return rv, take_counters()
+
+
+def take_counters():
+    """
+    Counters of every stage recorded since the last call
+    """
+    rv = {name: (t.calls, t.seconds, t.items, t.bytes_read, t.bytes_written) for name, t in timers.items()}
+    timers.clear()
+    return rv
+
+
+def merge(counters) -> None:
+    for name, (calls, seconds, items, bytes_read, bytes_written) in counters.items():
+        t = get_timer(name)
+        t.calls += calls
+        t.seconds += seconds
+        t.items += items
+        t.bytes_read += bytes_read
+        t.bytes_written += bytes_written
+
+
+def collect(results):
+    """
+    Yield the results of a pool mapping a Profiled function, merging the
+    counters sent back with each of them
+    """
+    for rv, counters in results:
+        if counters and enabled:
+            merge(counters)
+        yield rv
+
+
+def report():
+    rv = {
+        'wall_seconds': round(time.perf_counter() - _start, 4),
+        'stages': {name: t.serialize() for name, t in timers.items()},
+    }
+    if trace_memory:
+        rv['peak_traced_memory'] = max(_peak, tracemalloc.get_traced_memory()[1])
+    if resource is not None:
+        ## Bytes on macOS, kB everywhere else
+        rv['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            rv['max_rss'] *= 1024
+    return rv
+
+
+def format_report(rv) -> str:
+    lines = [f"{'Stage':<24} {'Calls':>7} {'Seconds':>9} {'Items':>8} {'Items/s':>11} {'Read':>10} {'Written':>10}" + (f" {'Peak mem':>10}" if trace_memory else '')]
+    for name, stage in rv['stages'].items():
+        line = f"{name:<24} {stage['calls']:>7} {stage['seconds']:>9.3f} {stage['items']:>8} {stage['items_per_sec']:>11.1f} {format_size(stage['bytes_read']):>10} {format_size(stage['bytes_written']):>10}"
+        if trace_memory:
+            line += f" {format_size(stage['peak_memory']):>10}"
+        lines.append(line)
+    lines.append(f"Total: {rv['wall_seconds']:.3f}s")
+    if 'peak_traced_memory' in rv:
+        lines.append(f"Peak traced memory: {format_size(rv['peak_traced_memory'])}")
+    if 'max_rss' in rv:
+        lines.append(f"Max RSS: {format_size(rv['max_rss'])}")
+    return '\n'.join(lines)
+
+
+def format_size(size : int) -> str:
+    for unit in ('B', 'kB', 'MB'):
+        if size < 1024:
+            return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+        size /= 1024
+    return f'{size:.1f}GB'
+
+
+def save_report(rv, fname : str) -> None:
+    ## JSON if the name ends in .json, text otherwise
+    with open(fname, 'w') as f:
+        if fname.lower().endswith('.json'):
+            f.write(json.dumps(rv, indent=4))
+        else:
+            f.write(format_report(rv) + '\n')
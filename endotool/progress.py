@@ -0,0 +1,88 @@
+import sys
+import time
+
+
+class ProgressEvent:
+    """
+    State of a stage after an item finished
+    """
+    def __init__(self, stage : str, done : int, total : int, item : str, elapsed : float) -> None:
+        self.stage = stage
+        self.done = done
+        self.total = total
+        self.item = item
+        self.elapsed = elapsed
+
+    @property
+    def rate(self) -> float:
+        ## Items per second
+        return self.done / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def finished(self) -> bool:
+        return self.total is not None and self.done >= self.total
+
+
+class Progress:
+    """
+    Counts the finished items of one stage and passes an event to the callback
+    for each of them. Does nothing without a callback. total may be None if it
+    isn't known in advance.
+    """
+    def __init__(self, stage : str, total : int = None, callback = None) -> None:
+        self.stage = stage
+        self.total = total
+        self.callback = callback
+        self.done = 0
+        self.start = time.perf_counter()
+
+    def advance(self, item : str = '', count : int = 1) -> None:
+        self.done += count
+        if self.callback is not None:
+            self.callback(ProgressEvent(self.stage, self.done, self.total, item, time.perf_counter() - self.start))
+
+    def finish(self) -> None:
+        ## Stages with an unknown total have to say when they are done
+        if self.total is None:
+            self.total = self.done
+            if self.callback is not None:
+                self.callback(ProgressEvent(self.stage, self.done, self.total, '', time.perf_counter() - self.start))
+
+
+class ProgressBar:
+    """
+    Progress callback that draws a bar on a terminal, redrawn at most every
+    interval seconds. Anything else gets a plain line instead, less often.
+    """
+    WIDTH = 30
+
+    def __init__(self, file = sys.stderr, interval : float = 0.1, line_interval : float = 2.0) -> None:
+        self.file = file
+        self.tty = hasattr(file, 'isatty') and file.isatty()
+        self.interval = interval if self.tty else line_interval
+        self.last = {}
+
+    def __call__(self, event : ProgressEvent) -> None:
+        now = time.perf_counter()
+        ## The first and last event of a stage are always shown
+        if not event.finished and event.done > 1 and now - self.last.get(event.stage, 0) < self.interval:
+            return
+        self.last[event.stage] = now
+
+        if event.total:
+            count = f'{event.done}/{event.total} {100*event.done//event.total:3d}%'
+        else:
+            count = f'{event.done}'
+        status = f'{event.stage}: {count} {event.rate:.1f}/s'
+
+        if not self.tty:
+            self.file.write(status + '\n')
+        else:
+            if event.total:
+                filled = self.WIDTH*event.done//event.total
+                status = f'[{"#"*filled}{"-"*(self.WIDTH - filled)}] ' + status
+            ## Pad over the end of a longer previous line
+            self.file.write('\r' + f'{status} {event.item}'[:79].ljust(79))
+            if event.finished:
+                self.file.write('\n')
+        self.file.flush()
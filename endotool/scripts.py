@@ -1,13 +1,18 @@
-from typing import List
+from typing import List, Iterator, Tuple
 import struct
 import os
 import csv
 import sys
 import shutil
 import math
-
-from endotool import jis208
-from endotool.utils import pad_to_nearest
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+from endotool import jis208, profiler
+from endotool.utils import pad_to_nearest, padded_size, file_fingerprint
+from endotool.exo import ExoArchive
+from endotool.output import OutputFile
+from endotool.progress import Progress
 from endotool.file_structures.text import *
 
 CSV_DELIMETER = '|'
@@ -16,6 +21,7 @@ CSV_LINETERMINATOR = '\n'
 
 ELF_ENUM = 'ELF'
 EXO_ENUM = 'EXO'
+SCRIPT_CACHE_SUFFIX = '.scripts.json'
 RESERVED = 0x33D600
 EXO_POINTERS     = 0x02C8268
 EXO_POINTERS_END = 0x02F8D50
@@ -44,32 +50,23 @@ ELF_POINTERS = [
     ]
 
 
-def string_size(data):
+def string_size(data, offset=0):
     size = 0
-    pos = data.tell()
+    pos = offset
     while True:
-        char = struct.unpack('>H', data.read(2))[0]
-        if char == 0x0:
-            data.seek(pos)
+        if data[pos] == 0 and data[pos+1] == 0:
             return size
-        if char % 0x100 == jis208.LINEBREAK:
-            data.seek(-1, 1)
+        if data[pos+1] == jis208.LINEBREAK:
+            pos += 1
             size += 1
         else:
+            pos += 2
             size += 2
 
-def is_empty(data, size):
-    pos = data.tell()
-    currentsize = 0
-    while currentsize <= size:
-        char = struct.unpack('H', data.read(2))[0]
-        if char != 0x0:
-            data.seek(pos)
-            return False
-        currentsize += 2
-
-    data.seek(pos)
-    return True
+def is_empty(data, size, offset=0):
+    ## The check covers size rounded down to 2 bytes, plus one more 2 byte word
+    end = offset + (size // 2 + 1) * 2
+    return bytes(data[offset:end]).count(0) == end - offset
 
 def hex_length(string):
     size = len(string)
@@ -106,22 +103,25 @@ def dec2hex(num):
 def hex2dec(num):
     return hex(num, 16)
 
-def getExoBlocks(elf_file, exo_file) -> List[ExoScriptBlock]:
-    #######
-    ## Extract EXO.bin texts
-    #######
-    elf_file.seek(EXO_POINTERS)
-    blocks : List[ExoScriptBlock] = []
+def getExoBlocks(elf_file, exo : ExoArchive, jobs : int = 1) -> List[ExoScriptBlock]:
+    return list(iterExoBlocks(elf_file, exo, jobs))
+
+def iterExoPointers(elf_file) -> Iterator[Tuple[int, int, int]]:
+    """
+    Yield the ELF address, EXO size and EXO address of every EXO script block
+    """
+    next_address = EXO_POINTERS
 
     while True:
-        elf_address = elf_file.tell()
+        ## Seek every time since the caller may use the file between blocks
+        elf_address = next_address
         if elf_address >= EXO_POINTERS_END:
             break
 
-        # print(f"Processing EXO block at ELF address {dec2hex(elf_address)}")
-
+        elf_file.seek(elf_address)
         exo_size = struct.unpack('<I', elf_file.read(4))[0]
         unknown = struct.unpack('<I', elf_file.read(4))[0]
+        next_address = elf_address + 8
 
         if exo_size == 0 or exo_size == 0xFFFFFFFF:
             continue
@@ -133,21 +133,56 @@ def getExoBlocks(elf_file, exo_file) -> List[ExoScriptBlock]:
 
         exo_address = struct.unpack('<I', elf_file.read(4))[0]
         zeros = struct.unpack('<I', elf_file.read(4))[0]
+        next_address = elf_address + 16
+
+        yield elf_address, exo_size, exo_address
+
+def readExoBlock(exo : ExoArchive, pointer : Tuple[int, int, int]) -> ExoScriptBlock:
+    elf_address, exo_size, exo_address = pointer
+
+    # print(f"Processing EXO block at ELF address {dec2hex(elf_address)}")
+
+    ## Go to the block in the EXO file and read it
+    exoblock = ExoScriptBlock(
+        exo_size=exo_size,
+        elf_address=elf_address,
+        exo_address=exo_address
+    )
+    exoblock.fromBinary(exo)
+    return exoblock
 
-        ## Go to the block in the EXO file, read it, then save it to csv
-        exoblock = ExoScriptBlock(
-            exo_size=exo_size,
-            elf_address=elf_address,
-            exo_address=exo_address
-        )
-        exoblock.fromBinary(exo_file)
+def encodeExoBlock(exoblock : ExoScriptBlock) -> Tuple[bytes, int]:
+    ## toBinary updates exo_size, which worker processes need to send back
+    bin_data = exoblock.toBinary()
+    return bin_data, exoblock.exo_size
 
-        blocks.append(exoblock)
-    return blocks
+_worker_exo : ExoArchive = None
 
-def extract(fname_elf, fname_exo, fname_csv, overwrite = False):
+def _init_worker(fname_exo : str) -> None:
+    global _worker_exo
+    _worker_exo = ExoArchive(fname_exo)
+
+def _read_worker(pointer : Tuple[int, int, int]) -> ExoScriptBlock:
+    return readExoBlock(_worker_exo, pointer)
+
+def iterExoBlocks(elf_file, exo : ExoArchive, jobs : int = 1) -> Iterator[ExoScriptBlock]:
+    #######
+    ## Extract EXO.bin texts
+    ## Blocks are yielded in order as soon as they are decoded. With more than
+    ## one job, they are decoded by worker processes that map EXO.BIN themselves
+    #######
+    if jobs <= 1:
+        for pointer in iterExoPointers(elf_file):
+            yield readExoBlock(exo, pointer)
+        return
+
+    pointers = list(iterExoPointers(elf_file))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(exo.fname,)) as executor:
+        yield from profiler.collect(executor.map(profiler.Profiled(_read_worker), pointers, chunksize=16))
+
+def extract(fname_elf, fname_exo, fname_csv, overwrite = False, jobs = 1, progress = None):
     elf_file = open(fname_elf, 'rb')
-    exo_file = open(fname_exo, 'rb')
+    exo = ExoArchive(fname_exo)
 
     if os.path.exists(fname_csv) and not overwrite:
         print("CSV already exists. Use the overwrite flag if you want to overwrite this file")
@@ -159,6 +194,7 @@ def extract(fname_elf, fname_exo, fname_csv, overwrite = False):
     #######
     ## Extract ELF texts
     #######
+    profiler.start('script-elf-texts')
     elf_mgr = ElfTextManager()
     elf_mgr.readFromFile(elf_file)
 
@@ -173,16 +209,18 @@ def extract(fname_elf, fname_exo, fname_csv, overwrite = False):
             '',# EN Text
         ]
         writer.writerow(row)
+    profiler.stop('script-elf-texts', items = len(elf_mgr.text_entries))
 
     #######
     ## Extract EXO.bin texts
     #######
-    print("Reading EXO data")
-    blocks = getExoBlocks(elf_file, exo_file)
-
-    print("Writing CSV")
-    ## Write output
-    for exoblock in blocks:
+    print("Writing EXO texts")
+    profiler.start('script-exo-blocks')
+    written = Progress('Extracting EXO blocks', None, progress)
+    ## Each block is written as soon as it has been read
+    for exoblock in iterExoBlocks(elf_file, exo, jobs):
+        profiler.count('script-exo-blocks', items = 1, bytes_read = exoblock.exo_size)
+        written.advance(dec2hex(exoblock.exo_address))
         wrote = False
         for entry in exoblock.text_entries:
 
@@ -205,180 +243,284 @@ def extract(fname_elf, fname_exo, fname_csv, overwrite = False):
 
         if wrote:
             writer.writerow([])
+    written.finish()
+    profiler.stop('script-exo-blocks')
 
     elf_file.close()
-    exo_file.close()
+    exo.close()
     csv_file.close()
     print("Done")
 
-def rebuild(fname_csv, fname_elf_in, fname_elf_out, fname_exo_in, fname_exo_out):
-    csvfile = open(fname_csv, 'r', encoding='utf-8')
+def rebuild(fname_csv, fname_elf_in, fname_elf_out, fname_exo_in, fname_exo_out, in_place = False, jobs = 1, progress = None):
+    ## When patching in place, the block cache from the previous run lets
+    ## blocks whose texts didn't change be skipped or just moved
+    fname_cache = fname_exo_out + SCRIPT_CACHE_SUFFIX
 
     # Use the backup ELF as the basis for our new write
-    elf_file_out = open(fname_elf_out, 'wb+')
-    with open(fname_elf_in, 'rb') as elf_file_in:
-        elf_file_out.write(elf_file_in.read())
+    elf_file_in = open(fname_elf_in, 'rb')
+    elf_file_out = OutputFile(fname_elf_in, fname_elf_out, in_place, restore = False)
 
     # Use the backup EXO as the basis for our new write
-    exo_file_out = open(fname_exo_out, 'wb+')
-    with open(fname_exo_in, 'rb') as exo_file_in:
-        exo_file_out.write(exo_file_in.read())
+    exo_in = ExoArchive(fname_exo_in)
+    exo_file_out = OutputFile(fname_exo_in, fname_exo_out, in_place, restore = False)
+
+    fnames = {'elf_in': fname_elf_in, 'elf_out': fname_elf_out, 'exo_in': fname_exo_in, 'exo_out': fname_exo_out}
+    cache = None
+    if elf_file_out.patched and exo_file_out.patched:
+        cache = load_script_cache(fname_cache, fnames)
+
+    if cache is None:
+        elf_file_out.restore()
+        exo_file_out.restore()
+        old_blocks = {}
+    else:
+        print(f"Updating existing output: {fname_exo_out}")
+        old_blocks = cache['blocks']
+
+    new_blocks, unchanged = pack_scripts(fname_csv, elf_file_in, exo_in, elf_file_out, exo_file_out, jobs, old_blocks, progress)
+
+    elf_file_in.close()
+    exo_in.close()
+    elf_file_out.close()
+    exo_file_out.close()
 
-    ## Read all the csv lines
-    csv_raw = csvfile.read().replace('\0', '').split('\n')
-    reader = csv.reader(csv_raw, delimiter=CSV_DELIMETER, escapechar=CSV_ESCAPECHAR, lineterminator=CSV_LINETERMINATOR)
-    csv_data = [r for r in reader]
-    csvfile.close()
+    with open(fname_cache, 'w') as f:
+        f.write(json.dumps({
+            'files': {key: file_fingerprint(fname) for key, fname in fnames.items()},
+            'blocks': new_blocks,
+        }))
 
-    ## Pre-process the CSV data
-    print("Processing CSV file")
-    elf_rows = {}
-    exo_rows = {}
-    for row in csv_data:
-        if len(row)==0:
-            continue
+    if cache is not None:
+        print(f"Skipped {len(unchanged)} unchanged blocks")
+    print("Done")
 
-        if row[0] == ELF_ENUM:
-            elf_pointer = int(row[1], 16)
-            if elf_pointer in elf_rows:
-                elf_rows[elf_pointer].append(row)
-            else:
-                elf_rows[elf_pointer] = [row]
-        elif row[0] == EXO_ENUM:
-            elf_pointer = int(row[1], 16)
-            if elf_pointer in exo_rows:
-                exo_rows[elf_pointer].append(row)
-            else:
-                exo_rows[elf_pointer] = [row]
+
+def load_script_cache(fname_cache, fnames : dict):
+    """
+    Get the EXO block layout recorded by the previous rebuild. Returns None if
+    any of the ELF and EXO files changed since it was written.
+    """
+    if not os.path.exists(fname_cache):
+        return None
+
+    try:
+        with open(fname_cache, 'r') as f:
+            cache = json.loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+    ## Other commands can write to the same outputs, which keeps the patch
+    ## state valid but not the block layout
+    fingerprints = cache.get('files', {})
+    for key, fname in fnames.items():
+        if fingerprints.get(key) != file_fingerprint(fname):
+            return None
+
+    return cache
+
+
+def readCsvRows(fname_csv) -> Iterator[list]:
+    """
+    Yield the rows of a script CSV file one at a time
+    """
+    with open(fname_csv, 'r', encoding='utf-8') as csvfile:
+        lines = (line.replace('\0', '').rstrip('\n') for line in csvfile)
+        yield from csv.reader(lines, delimiter=CSV_DELIMETER, escapechar=CSV_ESCAPECHAR, lineterminator=CSV_LINETERMINATOR)
+
+def pack_scripts(fname_csv, elf_file_in, exo_in : ExoArchive, elf_file_out, exo_file_out, jobs = 1, old_blocks : dict = None, progress = None):
+    """
+    Write the texts from the CSV file into ELF and EXO.BIN file-like objects.
+    The original texts are read from elf_file_in and exo_in, which are not
+    modified. elf_file_in may be the same object as elf_file_out.
+    With more than one job, blocks are decoded and encoded in worker processes.
+
+    old_blocks is the block layout from a previous run into the same outputs.
+    Blocks with the same texts are not encoded again, and are only rewritten
+    if they have to move. Returns the new layout and the skipped blocks.
+    progress is called with a ProgressEvent for every block encoded.
+    """
+    if old_blocks is None:
+        old_blocks = {}
 
     #######
-    ## ELF Blocks
-    ## Process EXO rows and add translated text to them
+    ## Load the original texts so CSV rows can be applied as they are read
     #######
     print("Reading old ELF data")
+    profiler.start('script-read-elf')
     elf_mgr = ElfTextManager()
-    elf_mgr.readFromFile(elf_file_out)
+    elf_mgr.readFromFile(elf_file_in)
+    profiler.stop('script-read-elf', items = len(elf_mgr.text_entries))
 
-    print("Rebuilding ELF file")
-    for elf_address, rows in elf_rows.items():
-        for row in rows:
+    print("Reading old EXO data")
+    profiler.start('script-read-exo')
+    blocks: list[ExoScriptBlock] = getExoBlocks(elf_file_in, exo_in, jobs)
+    block_index = {block.elf_address: block for block in blocks}
+    profiler.stop('script-read-exo', items = len(blocks))
+
+    print("Processing CSV file")
+    profiler.start('script-apply-csv')
+    for row in readCsvRows(fname_csv):
+        profiler.count('script-apply-csv', items = 1)
+        if len(row)==0:
+            continue
+
+        if row[0] == ELF_ENUM:
             elf_address = int(row[1], 16)
-            exo_block = int(row[2], 16)
-            text_address = int(row[3], 16)
             item_num = int(row[4])
-            text_jp = row[5].strip()
-            text_en = row[6].strip()
-
-            found_entry : TextEntry = None
-            for entry in elf_mgr.text_entries:
-                if elf_address == entry.elf_address and item_num == entry.item_num:
-                    found_entry = entry
-                    break
+
+            found_entry : TextEntry = elf_mgr.getEntry(elf_address, item_num)
             if found_entry is None:
                 raise Exception("ELF Entry not found")
 
-            if text_en != '':
-                found_entry.text = text_en
-                found_entry.transform_ascii = True
-            else:
-                found_entry.text = text_jp
-                found_entry.transform_ascii = False
-
-    elf_mgr.writeToFile(elf_file_out)
-
-
-    #######
-    ## EXO Blocks
-    ## Load up the blocks from the original file and save them as-is, but more compressed
-    #######
-    print("Reading old EXO data")
-    blocks: list[ExoScriptBlock] = getExoBlocks(elf_file_out, exo_file_out)
-
-    print("Rebuilding EXO file")
-    ## Process EXO rows nd add translated text to them
-    for elf_pointer, rows in exo_rows.items():
-        for row in rows:
+        elif row[0] == EXO_ENUM:
             elf_pointer = int(row[1], 16)
-            exo_block = int(row[2], 16)
-            text_address = int(row[3], 16)
             item_num = int(row[4])
-            text_jp = row[5].strip()
-            text_en = row[6].strip()
-
-            found_entry : ExoScriptBlock = None
-            for entry in blocks:
-                if elf_pointer == entry.elf_address:
-                    found_entry = entry
-                    break
-            if found_entry is None:
-                raise Exception("EXO Block not found")
 
+            found_block : ExoScriptBlock = block_index.get(elf_pointer)
+            if found_block is None:
+                raise Exception("EXO Block not found")
 
-            found_entry : TextEntry = None
-            for entry in entry.text_entries:
-                if entry.item_num == item_num:
-                    found_entry = entry
-                    break
+            found_entry : TextEntry = found_block.getEntry(item_num)
             if found_entry is None:
                 raise Exception("EXO Entry not found")
 
-            if text_en != '':
-                found_entry.text = text_en
-                found_entry.transform_ascii = True
-            else:
-                found_entry.text = text_jp
-                found_entry.transform_ascii = False
+        else:
+            continue
 
+        text_jp = row[5].strip()
+        text_en = row[6].strip()
 
-    ## Create the final hex blocks
-    curr_exo_address = blocks[0].exo_address
+        if text_en != '':
+            found_entry.text = text_en
+            found_entry.transform_ascii = True
+        else:
+            found_entry.text = text_jp
+            found_entry.transform_ascii = False
+    profiler.stop('script-apply-csv')
 
-    for entry in blocks:
-        # print(f'{entry.exo_address:02X}')
-        bin_data = entry.toBinary()
+    #######
+    ## ELF Blocks
+    #######
+    print("Rebuilding ELF file")
+    profiler.start('script-write-elf')
+    elf_mgr.writeToFile(elf_file_out)
+    profiler.stop('script-write-elf', items = len(elf_mgr.text_entries))
 
-        ## Adjust the ELF file
-        elf_file_out.seek(entry.elf_address)
-        elf_file_out.write(struct.pack("<I", entry.exo_size))
-        elf_file_out.write(struct.pack("<I", 0))
-        elf_file_out.write(struct.pack("<I", curr_exo_address))
-        elf_file_out.write(struct.pack("<I", 0))
+    #######
+    ## EXO Blocks
+    ## Save the blocks from the original file as-is, but more compressed
+    #######
+    print("Rebuilding EXO file")
 
-        ## Write the EXO block
+    ## Only blocks whose texts changed need to be encoded again
+    profiler.start('script-encode')
+    hashes = {block.elf_address: block.textHash() for block in blocks}
+    changed = []
+    for block in blocks:
+        old = old_blocks.get(str(block.elf_address))
+        if old is None or old['hash'] != hashes[block.elf_address]:
+            changed.append(block)
+
+    encoded = {}
+    encoding = Progress('Encoding EXO blocks', len(changed), progress)
+    def collect(results):
+        for block, result in zip(changed, results):
+            encoded[block.elf_address] = result
+            encoding.advance(dec2hex(block.exo_address))
+
+    if jobs <= 1:
+        collect(map(encodeExoBlock, changed))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            collect(profiler.collect(executor.map(profiler.Profiled(encodeExoBlock), changed, chunksize=16)))
+    profiler.stop('script-encode', items = len(changed))
+
+    ## Lay the blocks out. Only the addresses depend on the previous blocks
+    layout = []
+    curr_exo_address = blocks[0].exo_address
+    for block in blocks:
+        if block.elf_address in encoded:
+            size = len(encoded[block.elf_address][0])
+        else:
+            size = old_blocks[str(block.elf_address)]['size']
+        layout.append(curr_exo_address)
+        curr_exo_address += padded_size(size, k=1024)
+
+    ## Unchanged blocks that moved are read back from the output before anything is overwritten
+    unchanged = []
+    for block, address in zip(blocks, layout):
+        old = old_blocks.get(str(block.elf_address))
+        if block.elf_address in encoded:
+            continue
+        if old['address'] == address:
+            unchanged.append(block.elf_address)
+            continue
+        exo_file_out.seek(old['address'])
+        encoded[block.elf_address] = (exo_file_out.read(old['size']), old['exo_size'])
+
+    profiler.start('script-write-exo')
+    new_blocks = {}
+    for block, address in zip(blocks, layout):
+        if block.elf_address in encoded:
+            bin_data, block.exo_size = encoded[block.elf_address]
+
+            ## Adjust the ELF file
+            elf_file_out.seek(block.elf_address)
+            elf_file_out.write(struct.pack("<I", block.exo_size))
+            elf_file_out.write(struct.pack("<I", 0))
+            elf_file_out.write(struct.pack("<I", address))
+            elf_file_out.write(struct.pack("<I", 0))
+
+            ## Write the EXO block
+            exo_file_out.seek(address)
+            exo_file_out.write(bin_data)
+            profiler.count('script-write-exo', items = 1, bytes_written = len(bin_data))
+
+            new_blocks[str(block.elf_address)] = {
+                'hash': hashes[block.elf_address],
+                'address': address,
+                'exo_size': block.exo_size,
+                'size': len(bin_data),
+            }
+        else:
+            new_blocks[str(block.elf_address)] = old_blocks[str(block.elf_address)]
+    profiler.stop('script-write-exo')
+
+    ## Put back the original data after the blocks if they used to go further
+    old_end = max((old['address'] + padded_size(old['size'], k=1024) for old in old_blocks.values()), default=0)
+    if old_end > curr_exo_address:
         exo_file_out.seek(curr_exo_address)
-        exo_file_out.write(bin_data)
+        exo_file_out.write(exo_in.block(curr_exo_address, old_end - curr_exo_address))
 
-        curr_exo_address += len(pad_to_nearest(bin_data, k=1024))
+        ## The previous blocks may also have made the file longer than the input
+        if old_end > len(exo_in):
+            exo_file_out.truncate(max(curr_exo_address, len(exo_in)))
 
-    elf_file_out.close()
-    exo_file_out.close()
-    print("Done")
+    return new_blocks, unchanged
 
 
 def calculateFreeSpace(elf, exo):
-    elf_file = open(elf, 'rb')
-    exo_file = open(exo, 'rb')
-
-    #######
-    ## Extract EXO.bin texts
-    #######
-    elf_file.seek(EXO_POINTERS)
+    with open(elf, 'rb') as elf_file, ExoArchive(exo) as exo_file:
+        #######
+        ## Extract EXO.bin texts
+        #######
+        elf_file.seek(EXO_POINTERS)
 
-    prev_block_val = 0
+        prev_block_val = 0
 
-    text_bytes = 0
-    free_bytes = 0
+        text_bytes = 0
+        free_bytes = 0
 
-    blocks = getExoBlocks(elf_file, exo_file)
-    for exoblock in blocks:
+        blocks = getExoBlocks(elf_file, exo_file)
+        for exoblock in blocks:
 
-        block_val = exoblock.exo_address/2048
-        if block_val != prev_block_val:
-            print("Non consequtive block detected")
+            block_val = exoblock.exo_address/2048
+            if block_val != prev_block_val:
+                print("Non consequtive block detected")
 
-        remaining_size_in_block = 2048 - exoblock.exo_size%2048
+            remaining_size_in_block = 2048 - exoblock.exo_size%2048
 
-        print(f"""
+            print(f"""
 ELF: {exoblock.elf_address:08X} |
 Exo: {exoblock.exo_address:08X} |
 Blocks: {exoblock.exo_address/2048:0.0f} + {math.ceil(exoblock.exo_size/2048):3.0f} |
@@ -386,15 +528,15 @@ Text bytes: {exoblock.text_size:5d} |
 Free bytes: {remaining_size_in_block:4d}
 """.replace("\n", " "), end="")
 
-        if (exoblock.text_size > 0):
-            print(f"| Percentage Free: {100*(remaining_size_in_block/exoblock.text_size):0.1f}%")
-        else:
-            print("")
+            if (exoblock.text_size > 0):
+                print(f"| Percentage Free: {100*(remaining_size_in_block/exoblock.text_size):0.1f}%")
+            else:
+                print("")
 
-        text_bytes += exoblock.text_size
-        free_bytes += remaining_size_in_block
+            text_bytes += exoblock.text_size
+            free_bytes += remaining_size_in_block
 
-        prev_block_val = block_val + math.ceil(exoblock.exo_size/2048)
+            prev_block_val = block_val + math.ceil(exoblock.exo_size/2048)
 
-    print(f"Text: {text_bytes} | Free: {free_bytes}")
+        print(f"Text: {text_bytes} | Free: {free_bytes}")
 
@@ -26,10 +26,13 @@ class TBL:
 
         tbl_file.close()
 
+        ## Character -> index. The first index wins if a character is listed twice
+        self.reverse = {}
+        for index, char in self.tbl.items():
+            self.reverse.setdefault(char, index)
+
     def index(self, char):
-        keys = list(self.tbl.keys())
-        values = list(self.tbl.values())
-        return keys[values.index(char)] if char in values else -1
+        return self.reverse.get(char, -1)
 
     def pos(self, char):
         index = self.index(char)
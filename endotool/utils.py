@@ -1,5 +1,14 @@
+import os
+import hashlib
+import shutil
 from shutil import which
 
+try:
+    import fcntl
+except ImportError:
+    ## Not available on Windows
+    fcntl = None
+
 basedir = ''
 
 def read_in_chunks(file_object, chunk_size = 4, size = 0):
@@ -28,4 +37,50 @@ def check_bin(name):
 def pad_to_nearest(input, k=16):
     ## Add enough zeros to pad it to the nearest multiple of k
     num_zeros = (k - (len(input) % k)) % k
-    return input + bytes(num_zeros)
\ No newline at end of file
+    return input + bytes(num_zeros)
+
+def padded_size(size, k=16):
+    ## Size after padding to the nearest multiple of k
+    return size + (k - (size % k)) % k
+
+def file_fingerprint(fname):
+    ## Cheap check for whether a file changed, without reading it
+    stat = os.stat(fname)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def file_hash(fname):
+    with open(fname, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+## ioctl request that clones a file's extents (reflink) on Linux
+FICLONE = 0x40049409
+
+def copy_file(fname_src, fname_dst):
+    ## Copy a file using the cheapest method available, without pulling it through Python
+    if os.path.exists(fname_dst) and os.path.samefile(fname_src, fname_dst):
+        return
+
+    with open(fname_src, 'rb') as src, open(fname_dst, 'wb') as dst:
+        ## Copy-on-write clone. Only supported by some filesystems (btrfs, XFS, ...)
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+            except OSError:
+                pass
+
+        ## Copy inside the kernel
+        if hasattr(os, 'copy_file_range'):
+            try:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                if remaining == 0:
+                    return
+            except OSError:
+                pass
+
+    shutil.copyfile(fname_src, fname_dst)
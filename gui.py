@@ -10,12 +10,16 @@ from tkinter import ttk, filedialog, messagebox, scrolledtext
 from PIL import Image, ImageTk
 import functools
 import os
+import sys
 import json
+import queue
+import inspect
 import threading
+import traceback
 import time
 import shutil
-import subprocess
 import configparser
+from endotool import font, scripts, images
 from endotool.file_structures.images import PackedImageInfo, Animation, FrameImageData, FrameTimingData, Rect, Vector2
 
 class DataManager(PackedImageInfo):
@@ -101,6 +105,78 @@ class MyCanvas(tk.Canvas):
         self.height = event.height
 
 
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    Runs a font, scripts or images function on a worker thread. Printed
+    output, progress events and the result are put on a queue that the UI
+    thread polls. Cancelling stops the function at its next progress event.
+    """
+    def __init__(self, title, func, **kwargs) -> None:
+        self.title = title
+        self.func = func
+        self.kwargs = kwargs
+        self.events = queue.Queue()
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        ## Lets JobOutput tell which job printed something
+        self.thread.job = self
+
+        if 'progress' in inspect.signature(func).parameters:
+            self.kwargs['progress'] = self.progress
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def is_running(self) -> bool:
+        return self.thread.is_alive()
+
+    def progress(self, event) -> None:
+        if self.cancelled.is_set():
+            raise JobCancelled()
+        self.events.put(('progress', event))
+
+    def run(self) -> None:
+        try:
+            rv = self.func(**self.kwargs)
+            self.events.put(('done', rv))
+        except JobCancelled:
+            self.events.put(('cancelled', None))
+        except Exception:
+            self.events.put(('error', traceback.format_exc()))
+
+
+class JobOutput:
+    """
+    Replaces sys.stdout and sys.stderr. Anything printed from a job's thread
+    goes to its queue, everything else to the original stream.
+    """
+    def __init__(self, stream) -> None:
+        self.stream = stream
+
+    def write(self, text) -> int:
+        job = getattr(threading.current_thread(), 'job', None)
+        if job is not None:
+            job.events.put(('output', text))
+        elif self.stream is not None:
+            ## No console with pythonw
+            self.stream.write(text)
+        return len(text)
+
+    def flush(self) -> None:
+        if self.stream is not None:
+            self.stream.flush()
+
+    def isatty(self) -> bool:
+        return False
+
+
 class ApplicationUI(tk.Tk):
     def __init__(self):
         super().__init__()
@@ -114,6 +190,10 @@ class ApplicationUI(tk.Tk):
         self.current_animation_tick = 0
         self.current_frame_timing_data_index = 0
         self.is_running_animation = False
+        self.job : Job = None
+
+        sys.stdout = JobOutput(sys.stdout)
+        sys.stderr = JobOutput(sys.stderr)
 
         self.ini_config = configparser.ConfigParser()
         if os.path.exists("config.ini"):
@@ -156,6 +236,16 @@ class ApplicationUI(tk.Tk):
         self.txt_output.grid(column=0, row=0, sticky="nwse", padx=3)
         main_frames[3].grid_columnconfigure(0, weight=1) # Expand the textbox horizontally
 
+        frame_job = tk.Frame(main_frames[3])
+        frame_job.grid(column=0, row=1, sticky="we", padx=3, pady=3)
+        frame_job.grid_columnconfigure(1, weight=1) # Expand the progress bar horizontally
+        self.job_label = tk.Label(frame_job, text="", width=40, anchor='w')
+        self.job_label.grid(column=0, row=0, sticky="w")
+        self.job_progressbar = ttk.Progressbar(frame_job, mode='determinate')
+        self.job_progressbar.grid(column=1, row=0, sticky="we", padx=3)
+        self.job_cancel_button = tk.Button(frame_job, text='Cancel', command=self.cancel_job, state='disabled')
+        self.job_cancel_button.grid(column=2, row=0, sticky="e", padx=3)
+
         #######################
         ## GUI
         #######################
@@ -588,7 +678,7 @@ class ApplicationUI(tk.Tk):
             fdir, fname = os.path.split(self.ini_config["paths"]["font_extract"])
             path_bmp = filedialog.asksaveasfilename(
                 title='Extracted font',
-                filetypes=(('Bitmap', '*.bmp'),),
+                filetypes=(('Bitmap', '*.bmp'), ('PNG', '*.png')),
                 initialfile=fname,
                 initialdir=fdir,
             )
@@ -598,8 +688,7 @@ class ApplicationUI(tk.Tk):
             self.save_ini_config()
 
         cmd = f'python endonesia-tool.py font-extract -e "{path_elf}" -f "{path_bmp}"'
-        thread = threading.Thread(target=self.run_commandline, args=(cmd,))
-        thread.start()
+        self.run_job(cmd, font.extract, fname_elf=path_elf, fname_font=path_bmp)
 
 
     def command_rebuild_font(self, fast=False):
@@ -677,8 +766,7 @@ class ApplicationUI(tk.Tk):
             self.save_ini_config()
 
         cmd = f'python endonesia-tool.py font-rebuild -f "{path_font}" -v "{path_font_width}" -ei "{path_input}" -eo "{path_output}"'
-        thread = threading.Thread(target=self.run_commandline, args=(cmd,))
-        thread.start()
+        self.run_job(cmd, font.rebuild, fname_font=path_font, variable_width=path_font_width, fname_elf_in=path_input, fname_elf_out=path_output)
 
 
     def command_extract_script(self, fast=False):
@@ -737,8 +825,7 @@ class ApplicationUI(tk.Tk):
             self.save_ini_config()
 
         cmd = f'python endonesia-tool.py script-extract -e "{path_elf}" -x "{path_exo}" -c "{path_output}" -r'
-        thread = threading.Thread(target=self.run_commandline, args=(cmd,))
-        thread.start()
+        self.run_job(cmd, scripts.extract, fname_elf=path_elf, fname_exo=path_exo, fname_csv=path_output, overwrite=True)
 
 
     def command_rebuild_script(self, fast=False):
@@ -832,8 +919,7 @@ class ApplicationUI(tk.Tk):
             self.save_ini_config()
 
         cmd = f'python endonesia-tool.py script-rebuild -c "{path_csv}" -ei "{path_elf_input}" -eo "{path_elf_output}" -xi "{path_exo_input}" -xo "{path_exo_output}"'
-        thread = threading.Thread(target=self.run_commandline, args=(cmd,))
-        thread.start()
+        self.run_job(cmd, scripts.rebuild, fname_csv=path_csv, fname_elf_in=path_elf_input, fname_elf_out=path_elf_output, fname_exo_in=path_exo_input, fname_exo_out=path_exo_output)
 
 
     def command_extract_images(self, fast=False):
@@ -871,8 +957,7 @@ class ApplicationUI(tk.Tk):
             self.save_ini_config()
 
         cmd = f'python endonesia-tool.py image-extract -x "{path_exo_input}" -o "{path_images}"'
-        thread = threading.Thread(target=self.run_commandline, args=(cmd,))
-        thread.start()
+        self.run_job(cmd, images.unpack, fname_exo=path_exo_input, dir_output=path_images)
 
 
     def command_rebuild_images(self, fast=False):
@@ -923,46 +1008,79 @@ class ApplicationUI(tk.Tk):
             self.save_ini_config()
 
         cmd = f'python endonesia-tool.py image-rebuild -i "{path_images}" -xi "{path_exo_input}" -xo "{path_exo_output}"'
-        thread = threading.Thread(target=self.run_commandline, args=(cmd,))
-        thread.start()
+        self.run_job(cmd, images.rebuild, dir_input=path_images, fname_exo_in=path_exo_input, fname_exo_out=path_exo_output)
 
 
-    def run_commandline(self, cmd):
+    def run_job(self, cmd, func, **kwargs):
+        """
+        Run a tool function in this process. cmd is the matching terminal
+        command, shown in the output box.
+        """
+        if self.job is not None and self.job.is_running():
+            messagebox.showinfo("Busy", "Another command is still running. Wait for it to finish or cancel it.")
+            return
+
         self.txt_output.delete('1.0', tk.END)
         self.txt_output.insert(tk.END, f'> {cmd}\n\n')
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-
-        i = 0
-        while True:
-            output = process.stdout.read(1).decode() # read byte from pipe
-
-            if output == '' and process.poll() != None:
-                break
+        self.job_label.config(text="")
+        self.job_progressbar.config(mode='determinate', value=0)
+        self.job_cancel_button.config(state='normal')
 
-            if output != '':
-                i += 1
-                self.txt_output.insert("end", output)   # write character into Text Widget
+        self.job = Job(cmd, func, **kwargs)
+        self.job.start()
+        self.after(50, self.poll_job, self.job)
 
-                if i%150==0:
-                    self.txt_output.yview_moveto(1) # scroll to bottom
-                if output == '\n':
-                    i = 0
-                    self.txt_output.yview_moveto(1)
 
-        i = 0
+    def poll_job(self, job: Job):
+        ## Only the UI thread touches the widgets. Everything queued since the
+        ## last poll is handled at once.
+        output = []
+        finished = False
         while True:
-            output = process.stderr.read(1).decode() # read byte from pipe
-
-            if output == '' and process.poll() != None:
+            try:
+                kind, value = job.events.get_nowait()
+            except queue.Empty:
                 break
 
-            if output != '':
-                i += 1
-                self.txt_output.insert("end", output)   # write character into Text Widget
+            if kind == 'output':
+                output.append(value)
+            elif kind == 'progress':
+                self.show_progress(value)
+            elif kind == 'done':
+                finished = True
+                if isinstance(value, int) and value:
+                    output.append(f"\nFailed with exit code {value}\n")
+            elif kind == 'cancelled':
+                finished = True
+                output.append("\nCancelled. The output files may be incomplete.\n")
+            elif kind == 'error':
+                finished = True
+                output.append(value)
+
+        if output:
+            self.txt_output.insert(tk.END, ''.join(output))
+            self.txt_output.yview_moveto(1)
+
+        if finished:
+            self.job_cancel_button.config(state='disabled')
+        else:
+            self.after(50, self.poll_job, job)
+
+
+    def show_progress(self, event):
+        if event.total:
+            self.job_progressbar.config(maximum=event.total, value=event.done)
+            self.job_label.config(text=f"{event.stage}: {event.done}/{event.total}")
+        else:
+            self.job_label.config(text=f"{event.stage}: {event.done}")
 
-                if i%100==0:
-                    self.txt_output.yview_moveto(1) # scroll to bottom
 
+    def cancel_job(self):
+        if self.job is None or not self.job.is_running():
+            return
+        self.job.cancel()
+        self.job_cancel_button.config(state='disabled')
+        self.txt_output.insert(tk.END, "\nCancelling...\n")
         self.txt_output.yview_moveto(1)
 
 